@@ -2,27 +2,36 @@ import streamlit as st
 import streamlit.components.v1 as components
 import os
 import urllib.parse
-import urllib.request
-import json
-import re
 import time
-import concurrent.futures
-from agno.agent import Agent
-from agno.tools.serpapi import SerpApiTools
-from agno.models.google import Gemini
+import collections
+import functools
+import html
+import inspect
+import engine
+from engine import (TRIP_MONTHS, TRIP_BUDGETS, TRIP_PERSONAS, TRIP_MAX_DAYS, normalize_trip, trip_key, cached_dossier,
+                    iter_generation, get_image_cache, get_dossier_cache, get_dossier_store, get_exporter, get_tracer, get_trending_destinations, dossier_to_markdown,
+                    get_quota_scheduler, regenerate_section, speculate, release_speculation, proxy_images, proxy_image_url)
 
 # --- CONFIGURATION & SECRETS ---
 st.set_page_config(page_title="Academic Travel Planner", layout="wide", page_icon="✈️", initial_sidebar_state="expanded")
 
 # --- INITIALIZE SESSION STATE ---
-if 'itinerary_data' not in st.session_state:
-    st.session_state.itinerary_data = None
+if 'dossier_id' not in st.session_state:
+    st.session_state.dossier_id = None # the dossier itself lives in the shared store
 if 'dest_name' not in st.session_state:
     st.session_state.dest_name = ""
 if 'trip_params' not in st.session_state:
     st.session_state.trip_params = {}
 if 'celebrated' not in st.session_state:
     st.session_state.celebrated = False
+if 'dossier_key' not in st.session_state:
+    st.session_state.dossier_key = ""
+if 'last_trace_id' not in st.session_state:
+    st.session_state.last_trace_id = None
+if 'trip' not in st.session_state:
+    st.session_state.trip = None
+if 'speculation' not in st.session_state:
+    st.session_state.speculation = {"for": None, "keys": []}
 
 # --- OPTION 1: ADAPTIVE GLASSMORPHISM CSS ---
 st.markdown("""
@@ -124,116 +133,132 @@ except Exception:
 
 os.environ["GOOGLE_API_KEY"] = SYSTEM_GOOGLE_KEY
 
-# --- THE ULTIMATE WATERFALL IMAGE ENGINE ---
-def fetch_real_image(query):
-    """4-Tier Image Fetcher: Unsplash -> Smart Wikipedia -> SerpApi (Google Images) -> AI Failsafe"""
-    encoded_query = urllib.parse.quote(query)
-    
-    # TIER 1: Unsplash (Cinematic & Free)
-    if SYSTEM_UNSPLASH_KEY:
-        try:
-            url = f"https://api.unsplash.com/search/photos?query={encoded_query}&client_id={SYSTEM_UNSPLASH_KEY}&per_page=1&orientation=landscape"
-            req = urllib.request.Request(url, headers={'User-Agent': 'TravelPlanner/1.0'})
-            with urllib.request.urlopen(req, timeout=3) as response:
-                data = json.loads(response.read().decode())
-                if data['results']:
-                    return data['results'][0]['urls']['regular']
-        except Exception:
-            pass
-
-    # TIER 2: Smart Wikipedia Filter (Rejects maps and logos)
-    try:
-        clean_query = query.split(',')[0].strip() # Removes city name to prevent wiki confusion
-        search_url = f"https://en.wikipedia.org/w/api.php?action=query&list=search&srsearch={urllib.parse.quote(clean_query)}&utf8=&format=json"
-        req = urllib.request.Request(search_url, headers={'User-Agent': 'TravelPlanner/1.0'})
-        with urllib.request.urlopen(req, timeout=3) as response:
-            search_data = json.loads(response.read().decode())
-            if search_data['query']['search']:
-                title = search_data['query']['search'][0]['title']
-                image_url = f"https://en.wikipedia.org/w/api.php?action=query&titles={urllib.parse.quote(title)}&prop=pageimages&format=json&pithumbsize=1000"
-                
-                req2 = urllib.request.Request(image_url, headers={'User-Agent': 'TravelPlanner/1.0'})
-                with urllib.request.urlopen(req2, timeout=3) as response2:
-                    image_data = json.loads(response2.read().decode())
-                    pages = image_data['query']['pages']
-                    page_id = list(pages.keys())[0]
-                    if 'thumbnail' in pages[page_id]:
-                        img_src = pages[page_id]['thumbnail']['source']
-                        # SMART FILTER: Reject if it is a map, flag, logo, or icon
-                        lower_src = img_src.lower()
-                        if not any(bad_word in lower_src for bad_word in ['map', 'flag', 'logo', '.svg', 'icon']):
-                            return img_src
-    except Exception:
-        pass
-
-    # TIER 3: SerpApi Google Images (Pinpoint Accuracy for Restaurants/Specifics)
-    if SYSTEM_SERPAPI_KEY:
-        try:
-            url = f"https://serpapi.com/search.json?engine=google_images&q={encoded_query}&api_key={SYSTEM_SERPAPI_KEY}"
-            req = urllib.request.Request(url, headers={'User-Agent': 'TravelPlanner/1.0'})
-            with urllib.request.urlopen(req, timeout=3) as response:
-                data = json.loads(response.read().decode())
-                if 'images_results' in data and len(data['images_results']) > 0:
-                    return data['images_results'][0]['original']
-        except Exception:
-            pass
-    
-    # TIER 4: Pollinations AI (Failsafe Placeholder)
-    return f"https://image.pollinations.ai/prompt/Realistic+Cinematic+Photography+of+{encoded_query}?width=1000&height=500"
+# Every non-UI piece (agents, image waterfall, caches, tracing, the generation pipeline) lives in engine.py,
+# shared with batch.py; this script only renders what the engine reports.
+engine.configure_keys(google=SYSTEM_GOOGLE_KEY, serpapi=SYSTEM_SERPAPI_KEY, unsplash=SYSTEM_UNSPLASH_KEY)
 
+# --- DEBUG PANEL ---
+DEBUG_PANEL = os.environ.get("TRAVEL_PLANNER_DEBUG", "0") == "1"        # show the latest run's waterfall in the sidebar
+TRACE_KIND_ICONS = {"run": "🚀", "phase": "🧩", "agent": "🤖", "model": "🧠", "tool": "🔧", "images": "🖼️", "export": "📦"}
+TRACE_STATUS_COLORS = {"ok": "#22c55e", "hit": "#22c55e", "miss": "#94a3b8", "skipped": "#94a3b8",
+                       "cancelled": "#cbd5e1", "timeout": "#f59e0b", "error": "#ef4444"}
 
-def process_images(text):
-    """Finds all [REAL_IMG] placeholders and concurrently runs the Waterfall Engine."""
-    pattern = r"\[REAL_IMG:\s*(.*?)\]"
-    matches = list(set(re.findall(pattern, text)))
-    
-    if not matches:
-        return text
-        
-    def get_img_url(query):
-        return query, fetch_real_image(query)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        results = executor.map(get_img_url, matches)
-        
-    for query, url in results:
-        text = text.replace(f"[REAL_IMG: {query}]", url)
-        
-    return text
-
-# --- THE DAILY AI TREND SCOUT ---
-@st.cache_data(ttl=86400, show_spinner=False) # Caches the output for exactly 24 hours
-def get_trending_destinations():
-    """Fetches trending destinations for HK travelers autonomously and gets real photos."""
-    try:
-        agent = Agent(
-            name="Trend Scout",
-            model=Gemini(id="gemini-2.5-flash"), 
-            instructions=[
-                "You are an expert travel trend analyst for the Hong Kong market.",
-                "Identify the top 3 trending international travel destinations for Hong Kong tourists right now. Consider seasonal trends, favorable exchange rates (like the Japanese Yen), and current popularity.",
-                "Return ONLY a valid JSON array. Do NOT wrap it in markdown backticks (```json).",
-                'Format exactly like this: [{"destination": "City, Country", "description": "Short catchy description (max 10 words)"}]'
-            ]
-        )
-        response = agent.run("Get top 3 trending destinations for HK tourists.", stream=False).content
-        
-        # Strip potential markdown formatting just in case
-        cleaned_response = response.replace("```json", "").replace("```", "").strip()
-        destinations = json.loads(cleaned_response)
-        
-        # Fetch real photos using the waterfall engine
-        for dest in destinations[:3]:
-            dest['image_url'] = fetch_real_image(dest['destination'])
-            
-        return destinations[:3]
-    except Exception as e:
-        # Failsafe: Static trends if AI or internet fails
-        return [
-            {"destination": "Tokyo, Japan", "description": "Neon lights, ancient temples, and culinary perfection.", "image_url": "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?auto=format&fit=crop&w=600&h=400&q=80"},
-            {"destination": "Paris, France", "description": "Art, romance, and café culture by the Seine.", "image_url": "https://images.unsplash.com/photo-1499856871958-5b9627545d1a?auto=format&fit=crop&w=600&h=400&q=80"},
-            {"destination": "Banff, Canada", "description": "Crystal lakes, towering peaks, and ultimate wilderness.", "image_url": "https://images.unsplash.com/photo-1550236520-7050f3582da0?auto=format&fit=crop&w=600&h=400&q=80"}
-        ]
+def render_trace_panel(trace_id, tracer=None):
+    """Debug view of one run: a waterfall of its spans, that run's image-tier outcomes and the lifetime hit rates."""
+    tracer = tracer if tracer is not None else get_tracer()
+    spans = tracer.trace(trace_id) if trace_id else []
+    if not spans:
+        st.caption("No traced run yet. Generate a dossier to see its waterfall.")
+    else:
+        now = time.time()
+        t0 = min(span["start"] for span in spans)
+        total = max(max((span["end"] or now) for span in spans) - t0, 1e-6)
+        by_id = {span["span_id"]: span for span in spans}
+
+        def depth(span):
+            d = 0
+            while span["parent_id"] in by_id:
+                d, span = d + 1, by_id[span["parent_id"]]
+            return d
+
+        rows = []
+        run_tiers = {}
+        for span in sorted(spans, key=lambda s: s["start"]):
+            status = span["status"] or "running"
+            if span["kind"] == "image_tier":
+                # Hundreds of these per run: summarised in the table below instead of one bar each
+                run_tiers.setdefault(span["name"], collections.Counter())[status] += 1
+                continue
+            end = span["end"] or now
+            label = span["name"]
+            if span["kind"] == "images":
+                label = f"images ({span['attrs'].get('queries', 0)} places, {span['attrs'].get('cache_hits', 0)} cached)"
+            left = (span["start"] - t0) / total * 100
+            width = max((end - span["start"]) / total * 100, 0.5)
+            rows.append(
+                f'<div style="font-size: 0.72rem; margin-left: {depth(span) * 8}px;">{TRACE_KIND_ICONS.get(span["kind"], "•")} '
+                f'{html.escape(label)} <span style="color: #64748b;">{end - span["start"]:.2f}s · {status}</span></div>'
+                f'<div style="background: rgba(148,163,184,0.15); height: 6px; border-radius: 3px; margin: 0 0 4px {depth(span) * 8}px;">'
+                f'<div style="margin-left: {left:.2f}%; width: {width:.2f}%; height: 6px; border-radius: 3px; '
+                f'background: {TRACE_STATUS_COLORS.get(status, "#6366f1")};"></div></div>'
+            )
+        st.caption(f"Run `{trace_id}` · {total:.1f}s · {len(spans)} spans")
+        st.markdown("".join(rows), unsafe_allow_html=True)
+        if run_tiers:
+            st.markdown("**Image tiers (this run)**\n\n| Tier | Hit | Miss | Timeout | Error | Cancelled |\n|---|---|---|---|---|---|\n" + "\n".join(
+                f"| {tier} | {c['hit']} | {c['miss']} | {c['timeout']} | {c['error']} | {c['cancelled']} |" for tier, c in run_tiers.items()))
+
+    lifetime = tracer.span_counts("image_tier")
+    if lifetime:
+        lines = []
+        for tier, counts in lifetime.items():
+            attempts = sum(counts.values())
+            lines.append(f"| {tier} | {counts.get('hit', 0) / attempts:.0%} | {counts.get('timeout', 0)} | {attempts} |")
+        st.markdown("**Tier hit rates (this server)**\n\n| Tier | Hit rate | Timeouts | Attempts |\n|---|---|---|---|\n" + "\n".join(lines))
+
+    col1, col2 = st.columns(2)
+    col1.download_button("⬇️ Trace", data=functools.partial(tracer.to_jsonl, trace_id), file_name="trace.jsonl",
+                         mime="application/x-ndjson", use_container_width=True, disabled=not spans)
+    col2.download_button("⬇️ Metrics", data=tracer.prometheus_text, file_name="metrics.prom",
+                         mime="text/plain", use_container_width=True)
+
+
+# --- DOSSIER RENDERING ---
+LAZY_EXPANDERS = "on_change" in inspect.signature(st.expander).parameters  # Streamlit can skip closed expanders
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def dossier_markdown(dossier_id):
+    """Markdown export memoized by the dossier's content hash, decompressed from the store only on a click."""
+    return dossier_to_markdown(get_dossier_store().get(dossier_id))
+
+
+def dossier_export(dossier_id, fmt, title):
+    """Offline bundle built server-side on click (photos embedded); repeat exports come straight from the exporter's disk cache."""
+    with get_exporter().open(get_dossier_store().get(dossier_id), fmt, title) as bundle:
+        return bundle.read() # Streamlit buffers the whole payload anyway; hand it bytes and close the file here
+
+
+def current_dossier():
+    """The session's dossier from the shared store; if the store has dropped it, the trip cache may still have it."""
+    dossier = get_dossier_store().get(st.session_state.dossier_id)
+    if dossier is None and st.session_state.trip:
+        dossier = cached_dossier(st.session_state.trip)
+        st.session_state.dossier_id = get_dossier_store().put(dossier) if dossier else None
+    return dossier
+
+
+def render_day(dossier_id, index, day):
+    """One accordion per day; with lazy expanders a collapsed day costs nothing until it is opened."""
+    if LAZY_EXPANDERS:
+        expander = st.expander(day["title"], expanded=(index == 0), key=f"day_{dossier_id[:12]}_{index}", on_change="rerun")
+    else:
+        expander = st.expander(day["title"], expanded=(index == 0))
+    with expander:
+        if not LAZY_EXPANDERS or expander.open:
+            st.markdown(proxy_images(day["body"]), unsafe_allow_html=True)
+            render_redo("day", f"Redo {day['title'].split(':')[0]}", index)
+
+
+def render_redo(section, label, day_index=None):
+    """Redo one section (or one day) with a single agent call; every other section and its photos stay as they are."""
+    dossier = current_dossier()
+    if not st.session_state.trip:
+        return
+    key = f"redo_{section}_{day_index}_{dossier['id'][:12]}"
+    with st.popover(f"🔄 {label}"):
+        note = st.text_input("What should change? (optional)", key=f"{key}_note")
+        if st.button("Regenerate", key=key, type="primary", use_container_width=True):
+            try:
+                with st.spinner("✍️ Rewriting just this part..."):
+                    st.session_state.dossier_id = regenerate_section(st.session_state.trip, dossier, section, day_index, note)["id"]
+            except Exception as e:
+                st.error(f"🚨 Could not regenerate: {e}")
+                return
+            st.session_state.last_trace_id = None # the debug panel falls back to this latest run
+            st.rerun()
+
 
 # --- SIDEBAR: DASHBOARD LAYOUT ---
 with st.sidebar:
@@ -244,12 +269,12 @@ with st.sidebar:
     
     col1, col2 = st.columns(2)
     with col1:
-        num_days = st.number_input("📅 Days:", min_value=1, max_value=14, value=4)
+        num_days = st.number_input("📅 Days:", min_value=1, max_value=TRIP_MAX_DAYS, value=4)
     with col2:
-        travel_month = st.selectbox("🗓️ Month:", ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], index=2)
+        travel_month = st.selectbox("🗓️ Month:", TRIP_MONTHS, index=2)
         
-    traveler_persona = st.selectbox("👥 Persona:", ["Solo Independent Traveler", "Couple / DINKs", "Family with Young Children", "Seniors / Retirees", "Student Group"])
-    budget = st.select_slider("💰 Budget Level:", options=["Budget/Backpacker", "Mid-Range", "Luxury/Boutique"], value="Mid-Range")
+    traveler_persona = st.selectbox("👥 Persona:", TRIP_PERSONAS)
+    budget = st.select_slider("💰 Budget Level:", options=TRIP_BUDGETS, value="Mid-Range")
     
     user_preferences = st.text_area(
         "✍️ Custom Preferences:",
@@ -259,6 +284,34 @@ with st.sidebar:
     
     st.markdown("---")
     generate_btn = st.button("✨ Generate Premium Itinerary", use_container_width=True, type="primary")
+    regenerate_btn = st.button("🔄 Regenerate from Scratch", use_container_width=True, help="Ignore any saved dossier for these settings and run the agents again.")
+    generate_btn = generate_btn or regenerate_btn
+
+    img_stats = get_image_cache().stats()
+    st.caption(f"🗄️ Image cache: {img_stats['entries']} places · {img_stats['hits']} hits / {img_stats['misses']} misses")
+    dossier_stats = get_dossier_cache().stats()
+    st.caption(f"📚 Dossier cache: {dossier_stats['entries']} trips · {dossier_stats['hits']} hits / {dossier_stats['misses']} misses")
+    if engine.get_image_proxy():
+        proxy_stats = engine.get_image_bytes().cache.stats()
+        st.caption(f"🖼️ Image proxy: {proxy_stats['entries']} images · {proxy_stats['bytes'] / 1e6:.1f} MB on disk")
+
+    if DEBUG_PANEL:
+        with st.expander("🐞 Debug: latest run"):
+            render_trace_panel(st.session_state.last_trace_id or get_tracer().latest_trace_id(kind="run"))
+            quotas = get_quota_scheduler().snapshot()
+            if quotas:
+                st.markdown("**Quota buckets**\n\n| Bucket | Limit/min | Queued | Paused |\n|---|---|---|---|\n" + "\n".join(
+                    f"| {key} | {q['per_minute']:g} | {q['queued']} | {q['paused_for']:g}s |" for key, q in sorted(quotas.items())))
+
+# --- SPECULATIVE PREFETCH ---
+# Streamlit only reruns once the destination box is committed (Enter / focus out), so the input has settled here.
+# Logistics and hotels depend on nothing else the traveler is still choosing, so they start now and Generate adopts them.
+speculation_for = (" ".join(destination.lower().split()), traveler_persona)
+if SYSTEM_GOOGLE_KEY and speculation_for != st.session_state.speculation["for"]:
+    release_speculation(st.session_state.speculation["keys"]) # the previous destination's queued work is cancelled
+    # Recorded on the Generate run too (with nothing started), so the reruns after it don't speculate on the trip just generated
+    keys = [] if generate_btn else speculate(destination, traveler_persona)
+    st.session_state.speculation = {"for": speculation_for, "keys": keys}
 
 # --- INPUT VALIDATION & STATE RESET ---
 if generate_btn:
@@ -272,39 +325,48 @@ if generate_btn:
         "budget": budget,
         "persona": traveler_persona
     }
+    trip = normalize_trip(dict(st.session_state.trip_params, destination=destination, preferences=user_preferences))
+    st.session_state.dossier_key = trip_key(trip)
+    st.session_state.trip = trip
 
-    if not SYSTEM_GOOGLE_KEY:
-        st.error("🚨 API Key missing!")
-        st.stop()
-        
-    # Reset displays
-    st.session_state.itinerary_data = None
-    st.session_state.celebrated = False
+    # Identical trip already generated (by anyone): serve it instantly unless a fresh run was asked for
+    stored_dossier = None if regenerate_btn else cached_dossier(trip)
+    if stored_dossier:
+        st.session_state.dossier_id = get_dossier_store().put(stored_dossier)
+        st.session_state.celebrated = False
+        generate_btn = False
+    else:
+        if not SYSTEM_GOOGLE_KEY:
+            st.error("🚨 API Key missing!")
+            st.stop()
+            
+        # Reset displays
+        st.session_state.dossier_id = None
+        st.session_state.celebrated = False
 
 # --- MAIN SCREEN AREA ---
 
 # Empty State: Dynamic Inspiration Gallery
-if not generate_btn and not st.session_state.itinerary_data:
+if not generate_btn and not st.session_state.dossier_id:
     st.markdown('<h1 style="text-align: center; font-size: 3.5rem; font-weight: 900; margin-bottom: 0;">🌍 Destination Design Lab</h1>', unsafe_allow_html=True)
     st.markdown('<p style="text-align: center; font-size: 1.3rem; color: #64748b; margin-bottom: 40px;">Design your perfect travel itinerary</p>', unsafe_allow_html=True)
     st.info("👈 Use the Dashboard on the left to configure your parameters and generate a custom AI dossier!")
     
     st.markdown("### 📈 Trending Now for Hong Kong Travelers")
     
-    with st.spinner("🤖 AI Scout is fetching today's top travel trends..."):
-        trending_places = get_trending_destinations()
+    trending_places = get_trending_destinations()
         
     cols = st.columns(3)
     for i, col in enumerate(cols):
         if i < len(trending_places):
             place = trending_places[i]
             with col:
-                st.image(place.get("image_url", "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?auto=format&fit=crop&w=600&h=400&q=80"), use_container_width=True)
+                st.image(proxy_image_url(place.get("image_url", "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?auto=format&fit=crop&w=600&h=400&q=80")), use_container_width=True)
                 st.markdown(f"#### 📍 {place.get('destination', 'Unknown')}")
                 st.caption(place.get('description', ''))
 
 # Active State: Generating or Displaying Results
-if generate_btn or st.session_state.itinerary_data:
+if generate_btn or st.session_state.dossier_id:
     
     disp_dest = st.session_state.dest_name if st.session_state.dest_name else destination
     disp_days = st.session_state.trip_params.get("days", num_days)
@@ -315,7 +377,7 @@ if generate_btn or st.session_state.itinerary_data:
     st.markdown(f'<h1 style="text-align: center; font-size: 3rem; font-weight: 900;">{disp_dest.upper()}</h1>', unsafe_allow_html=True)
     
     safe_dest = urllib.parse.quote(disp_dest)
-    st.image(f"https://image.pollinations.ai/prompt/Beautiful+Cinematic+Landscape+Photography+of+{safe_dest}?width=1200&height=350", use_container_width=True)
+    st.image(proxy_image_url(f"https://image.pollinations.ai/prompt/Beautiful+Cinematic+Landscape+Photography+of+{safe_dest}?width=1200&height=350"), use_container_width=True)
     
     m1, m2, m3, m4 = st.columns(4)
     m1.metric("📍 Destination", disp_dest)
@@ -327,151 +389,69 @@ if generate_btn or st.session_state.itinerary_data:
     # --- THE ENTERTAINING LOADING SCREEN ---
     if generate_btn:
         status_container = st.empty()
+        preview_box = st.empty() # Days appear here as soon as the planner finishes writing them
         with status_container.status("🤖 **AI Agents researching in parallel...**", expanded=True) as status:
             loading_msg = st.empty() # Dynamic rotating text container
             
-            fallback_models = ["gemini-3-flash-preview", "gemini-3.1-flash-lite-preview", "gemini-2.5-flash"]
-            success = False
-            raw_content = ""
+            task_labels = {
+                "itinerary": "🗺️ Day-by-day itinerary drafted",
+                "logistics": "🛂 Logistics & local rules gathered",
+                "hotels": "🏨 Hotel shortlist ready",
+                "editor": "✍️ Executive welcome written",
+                "itinerary_images": "📸 Itinerary photos resolved",
+                "hotel_images": "📸 Hotel photos resolved",
+            }
+            msgs = ["🗺️ Mapping out optimal routes...", "🕵️‍♂️ Asking locals for hidden gems...", "🏨 Checking room availabilities...",
+                    "✍️ Polishing the executive summary...", "📸 Fetching cinematic photos...", "🎨 Applying finishing touches..."]
+
+            dossier = None
             last_error = ""
-            
-            for model_id in fallback_models:
-                try:
-                    st.write(f"⚙️ Initializing Engine: `{model_id}`...")
-                    
-                    agent_tools = []
-                    if SYSTEM_SERPAPI_KEY:
-                        agent_tools = [SerpApiTools(api_key=SYSTEM_SERPAPI_KEY)]
-                    
-                    def get_itinerary():
-                        agent = Agent(
-                            name="Itinerary Planner",
-                            model=Gemini(id=model_id),
-                            tools=agent_tools,
-                            instructions=[
-                                f"You are the Itinerary Planner for a {disp_days}-day trip to {disp_dest} in {disp_month}.",
-                                f"Traveler: '{disp_persona}'. Budget: '{disp_budget}'. Preferences: '{user_preferences}'.",
-                                "Generate ONLY the day-by-day schedule.",
-                                # OPTION 3 REQUIREMENT: Strict Header formatting
-                                "CRITICAL: You MUST start every single day with this exact header format: `## Day [Number]: [Theme of the Day]` (e.g., `## Day 1: Arrival & City Exploration`).",
-                                "For EVERY single location or restaurant, you MUST use this exact layout:",
-                                "### 📍 [Name of Location]",
-                                "**⏱️ Suggested Time:** [e.g., 2 hours] | **[🗺️ View on Google Maps](https://www.google.com/maps/search/?api=1&query=Location+Name)**",
-                                "<br><br>",
-                                "<img src=\"[REAL_IMG: Location Name, City]\">",
-                                "<br><br>",
-                                "*Write a short, engaging description.*",
-                                "> 🚊 **Transit to next location:** [e.g., 15 mins by subway/bus] | **Route:** From [Nearest Station/Stop of CURRENT location] to [Nearest Station/Stop of NEXT location]",
-                                "CRITICAL IMAGE RULE: You MUST use the exact syntax <img src=\"[REAL_IMG: Location Name, City]\"> for images."
-                            ]
-                        )
-                        return agent.run(f"Create the day-by-day itinerary for {disp_dest}.", stream=False).content
-
-                    def get_logistics():
-                        agent = Agent(
-                            name="Logistics Expert",
-                            model=Gemini(id=model_id),
-                            tools=agent_tools,
-                            instructions=[
-                                f"You are the Logistics Expert for a trip to {disp_dest}.",
-                                "Generate ONLY practical logistics and local rules.",
-                                "- **Flight & Airports:** Major entry points.",
-                                "- **Weather:** What to pack for this month.",
-                                "- **Transport:** Best way to get around.",
-                                "- **Etiquette:** 3 local rules to respect."
-                            ]
-                        )
-                        return agent.run(f"Gather logistics for {disp_dest}.", stream=False).content
-
-                    def get_hotels(itin_text):
-                        agent = Agent(
-                            name="Hotel Concierge",
-                            model=Gemini(id=model_id),
-                            tools=agent_tools,
-                            instructions=[
-                                f"Find 3 highly-rated hotels in {disp_dest} that fit the {disp_persona} persona.",
-                                "For EVERY hotel, use this exact layout:",
-                                "### 🏨 [Hotel Name]",
-                                "**[🗺️ View on Google Maps](https://www.google.com/maps/search/?api=1&query=Hotel+Name)**",
-                                "<br><br>",
-                                "<img src=\"[REAL_IMG: Hotel Name, City]\">",
-                                "<br><br>",
-                                "*Write a short explanation.*"
-                            ]
-                        )
-                        return agent.run(f"Find 3 highly-rated hotels in {disp_dest}.", stream=False).content
-
-                    def get_editor(itin_text):
-                        agent = Agent(
-                            name="Chief Editor",
-                            model=Gemini(id=model_id),
-                            instructions=[
-                                f"Write a short, engaging, 1-paragraph 'Executive Welcome' for a {disp_persona} traveling to {disp_dest}."
-                            ]
-                        )
-                        return agent.run(f"Write the Executive Welcome.", stream=False).content
-
-                    with concurrent.futures.ThreadPoolExecutor() as executor:
-                        st.write("🚀 **Phase 1:** Planning Itinerary & Logistics...")
-                        future_itin = executor.submit(get_itinerary)
-                        future_logistics = executor.submit(get_logistics)
-                        
-                        # Entertaining Polling Loop 1
-                        msgs1 = ["🗺️ Mapping out optimal routes...", "🕵️‍♂️ Asking locals for hidden gems...", "📝 Drafting day-by-day plans..."]
-                        i = 0
-                        while not (future_itin.done() and future_logistics.done()):
-                            loading_msg.info(msgs1[i % len(msgs1)])
-                            i += 1
-                            time.sleep(1.5)
-                        
-                        itinerary_content = future_itin.result()
-                        logistics_content = future_logistics.result()
-                        
-                        st.write("🚀 **Phase 2:** Scouting Hotels & Writing Welcome...")
-                        future_hotel = executor.submit(get_hotels, itinerary_content)
-                        future_editor = executor.submit(get_editor, itinerary_content)
-                        
-                        # Entertaining Polling Loop 2
-                        msgs2 = ["🏨 Checking room availabilities...", "🛎️ Contacting hotel concierges...", "✍️ Polishing the executive summary..."]
-                        i = 0
-                        while not (future_hotel.done() and future_editor.done()):
-                            loading_msg.info(msgs2[i % len(msgs2)])
-                            i += 1
-                            time.sleep(1.5)
-                        
-                        hotel_content = future_hotel.result()
-                        summary_content = future_editor.result()
-                        
-                        st.write("📸 **Phase 3:** Executing Waterfall Image Engine...")
-                        future_itin_img = executor.submit(process_images, itinerary_content)
-                        future_hotel_img = executor.submit(process_images, hotel_content)
-                        
-                        # Entertaining Polling Loop 3
-                        msgs3 = ["📸 Fetching cinematic photos...", "🖼️ Formatting the visual gallery...", "🎨 Applying finishing touches..."]
-                        i = 0
-                        while not (future_itin_img.done() and future_hotel_img.done()):
-                            loading_msg.info(msgs3[i % len(msgs3)])
-                            i += 1
-                            time.sleep(1.5)
-                            
-                        itinerary_content = future_itin_img.result()
-                        hotel_content = future_hotel_img.result()
+            preview_days = {}
+            preview_attempt = 0
+            i = 0
+            try:
+                # The engine runs all four agents and the image stages in its own threads and reports here as work lands
+                for kind, name, payload in iter_generation(trip):
+                    if kind == "start":
+                        st.session_state.last_trace_id = payload["trace_id"]
+                        st.write(f"⚙️ Engines available: {', '.join(f'`{m}`' for m in payload['engines'])}")
+                        if payload["joined"]:
+                            st.write("🤝 **Joining** an identical trip another traveler is already generating...")
+                        else:
+                            st.write("🚀 **Launching** Itinerary, Logistics, Hotel & Editor agents together...")
+                        loading_msg.info(msgs[0])
+                    elif kind == "idle":
+                        i += 1
+                        loading_msg.info(msgs[i % len(msgs)])
+                    elif kind == "reset":
+                        preview_attempt = payload
+                        preview_days.clear()
+                        preview_box.empty()
+                    elif kind == "day":
+                        # Progressive rendering: each finished day shows up while the rest is still being written
+                        attempt, index, header, segment = payload
+                        if attempt == preview_attempt:
+                            preview_days[index] = (header, segment)
+                            with preview_box.container():
+                                for _, (day_header, day_segment) in sorted(preview_days.items()):
+                                    if day_header is None:
+                                        st.markdown(proxy_images(day_segment), unsafe_allow_html=True)
+                                    else:
+                                        with st.expander(day_header.replace("## ", "").strip(), expanded=day_header.startswith("## Day 1:")):
+                                            st.markdown(proxy_images(day_segment.split("\n", 1)[1] if "\n" in day_segment else ""), unsafe_allow_html=True)
+                    elif kind == "images":
+                        st.write(f"🖼️ {payload['placeholders']} photos placed from {payload['unique_queries']} unique places"
+                                 + (f" · ⚠️ {payload['unresolved']} unresolved" if payload['unresolved'] else ""))
                         loading_msg.success("✨ Finalizing your dossier!")
+                    elif kind == "dossier":
+                        dossier = payload
+                    else:
+                        st.write(payload if kind == "note" else f"✅ {task_labels[name]}")
+            except Exception as e:
+                last_error = str(e)
 
-                    # Note the strict separation to ensure parsing works perfectly
-                    raw_content = f"{summary_content}\n\n---TAB_SEPARATOR---\n\n{itinerary_content}\n\n---TAB_SEPARATOR---\n\n{hotel_content}\n\n---TAB_SEPARATOR---\n\n{logistics_content}"
-                    
-                    success = True
-                    break 
-                    
-                except Exception as e:
-                    last_error = str(e)
-                    st.write(f"⚠️ `{model_id}` error. Switching to next engine...")
-                    time.sleep(1)
-                    continue
-                    
-            if success:
-                st.session_state.itinerary_data = raw_content
+            if dossier:
+                st.session_state.dossier_id = get_dossier_store().put(dossier)
                 status_container.empty() # Clear loading status for instant display
                 st.rerun() 
             else:
@@ -479,51 +459,48 @@ if generate_btn or st.session_state.itinerary_data:
                 st.error("🚨 All AI engines have hit limits or failed.")
                 st.code(f"Technical Error Data: {last_error}")
 
-    elif st.session_state.itinerary_data:
+    elif st.session_state.dossier_id:
+        dossier = current_dossier()
+        if dossier is None:
+            st.info("⌛ This dossier is no longer stored on the server. Click Generate to build it again.")
+            st.stop()
+
         if not st.session_state.celebrated:
             st.balloons()
             st.toast('Your custom itinerary has been successfully generated!', icon='🎉')
             st.session_state.celebrated = True
         
-        parts = st.session_state.itinerary_data.split("---TAB_SEPARATOR---")
-        
-        if len(parts) >= 4:
+        if dossier["complete"]:
             # Editor's Welcome sits beautifully outside the tabs
-            st.markdown(f"### 📝 Editor's Welcome\n{parts[0]}", unsafe_allow_html=True)
+            st.markdown(f"### 📝 Editor's Welcome\n{dossier['welcome']}", unsafe_allow_html=True)
+            render_redo("welcome", "Redo welcome")
             st.markdown("---")
             
             tab1, tab2, tab3 = st.tabs(["🗺️ Day-by-Day Itinerary", "🏨 Accommodations", "🛂 Logistics & Practicalities"])
             
             with tab1:
-                # OPTION 3: ACCORDION STYLE ITINERARY PARSING
-                itin_text = parts[1]
-                # Split the text beautifully by the mandatory Day header
-                days = re.split(r'(## Day \d+:.*)', itin_text)
-                
-                if len(days) > 1:
+                # OPTION 3: ACCORDION STYLE ITINERARY (days were parsed once at generation time)
+                if dossier["days"]:
                     # Render any introductory text before Day 1
-                    if days[0].strip():
-                        st.markdown(days[0], unsafe_allow_html=True)
+                    if dossier["intro"].strip():
+                        st.markdown(dossier["intro"], unsafe_allow_html=True)
                     
-                    # Loop through headers and content chunks
-                    for i in range(1, len(days), 2):
-                        day_header = days[i].replace("## ", "").strip()
-                        day_content = days[i+1] if i+1 < len(days) else ""
-                        
-                        # Expand the very first day by default, collapse the rest
-                        with st.expander(day_header, expanded=(i==1)):
-                            st.markdown(day_content, unsafe_allow_html=True)
+                    # Expand the very first day by default, collapse the rest
+                    for i, day in enumerate(dossier["days"]):
+                        render_day(dossier["id"], i, day)
                 else:
                     # Fallback just in case AI ignores formatting rules
-                    st.markdown(itin_text, unsafe_allow_html=True)
+                    st.markdown(dossier["intro"], unsafe_allow_html=True)
                     
             with tab2:
-                st.markdown(f"## 🏨 Top Accommodation Picks\n{parts[2]}", unsafe_allow_html=True)
+                st.markdown(f"## 🏨 Top Accommodation Picks\n{proxy_images(dossier['hotels'])}", unsafe_allow_html=True)
+                render_redo("hotels", "Redo hotels")
             with tab3:
-                st.markdown(f"## 🛂 Logistics & Practicalities\n{parts[3]}", unsafe_allow_html=True)
+                st.markdown(f"## 🛂 Logistics & Practicalities\n{dossier['logistics']}", unsafe_allow_html=True)
+                render_redo("logistics", "Redo logistics")
         else:
             st.warning("Displaying full dossier below:")
-            st.markdown(st.session_state.itinerary_data, unsafe_allow_html=True)
+            st.markdown(dossier["intro"], unsafe_allow_html=True)
         
         st.markdown("---")
         colA, colB = st.columns(2)
@@ -531,7 +508,7 @@ if generate_btn or st.session_state.itinerary_data:
         with colA:
             st.download_button(
                 label="📄 Download Raw Markdown (.md)",
-                data=st.session_state.itinerary_data.replace("---TAB_SEPARATOR---", "\n\n---\n\n"),
+                data=functools.partial(dossier_markdown, dossier["id"]), # built on click, memoized per dossier
                 file_name=f"Custom_Itinerary_{disp_dest.replace(' ', '_')}.md",
                 mime="text/markdown",
                 use_container_width=True
@@ -558,3 +535,23 @@ if generate_btn or st.session_state.itinerary_data:
                 """,
                 height=50
             )
+
+        colC, colD = st.columns(2)
+        with colC:
+            st.download_button(
+                label="🌐 Download Offline Page (.html)",
+                data=functools.partial(dossier_export, dossier["id"], "html", f"Travel Dossier: {disp_dest}"),
+                file_name=f"Custom_Itinerary_{disp_dest.replace(' ', '_')}.html",
+                mime="text/html",
+                use_container_width=True,
+                help="One file with every photo embedded: opens, prints and archives without a connection."
+            )
+        with colD:
+            st.download_button(
+                label="🗜️ Download Offline Bundle (.zip)",
+                data=functools.partial(dossier_export, dossier["id"], "zip", f"Travel Dossier: {disp_dest}"),
+                file_name=f"Custom_Itinerary_{disp_dest.replace(' ', '_')}.zip",
+                mime="application/zip",
+                use_container_width=True,
+                help="index.html and itinerary.md with the photos alongside in images/."
+            )
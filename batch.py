@@ -0,0 +1,161 @@
+"""Headless batch generation: turns a CSV or JSONL catalogue of trips into dossiers on disk.
+
+Each row is one trip with the sidebar's fields (destination, days, month, budget, persona, preferences); blank
+fields take the sidebar defaults. Every dossier is written the moment it is finished, as <slug>-<key>.md and/or
+.json, and recorded in manifest.jsonl, so an interrupted run picks up where it stopped: trips whose files already
+exist are skipped. Identical trips (same cache key) are generated once.
+
+Usage:
+    python batch.py trips.csv --out dossiers/
+    python batch.py trips.jsonl --out dossiers/ --concurrency 8 --rate-limit 60 --format md,json
+    python batch.py trips.csv --out dossiers/ --force      # redo every trip, ignoring files and the dossier cache
+
+Keys come from GOOGLE_API_KEY / SERPAPI_KEY / UNSPLASH_API_KEY, falling back to .streamlit/secrets.toml.
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import tomllib
+
+import engine
+
+FORMATS = ("md", "json")
+
+
+def read_specs(path):
+    """Yields (line number, raw trip) from a .csv file (header row required, dict rows) or a JSON-lines file (unparsed lines)."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            for number, row in enumerate(csv.DictReader(f), 2):
+                yield number, {k.strip().lower(): v for k, v in row.items() if k}
+            return
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, line
+
+
+def load_keys(secrets_path):
+    """Environment first, then the app's Streamlit secrets file for anything still missing."""
+    keys = {"google": os.environ.get("GOOGLE_API_KEY", ""), "serpapi": os.environ.get("SERPAPI_KEY", ""),
+            "unsplash": os.environ.get("UNSPLASH_API_KEY", "")}
+    try:
+        with open(secrets_path, "rb") as f:
+            secrets = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError):
+        secrets = {}
+    for name, secret in (("google", "GOOGLE_API_KEY"), ("serpapi", "SERPAPI_KEY"), ("unsplash", "UNSPLASH_API_KEY")):
+        keys[name] = keys[name] or secrets.get(secret, "")
+    return keys
+
+
+def output_stem(trip, key):
+    slug = re.sub(r"[^a-z0-9]+", "-", trip["destination"].lower()).strip("-")[:48] or "trip"
+    return f"{slug}-{trip['days']}d-{key[:12]}"
+
+
+def write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class Manifest:
+    """Append-only JSON-lines log of every trip outcome, safe to write from many workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, **entry):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(entry, at=time.time()), ensure_ascii=False) + "\n")
+
+
+def run_trip(trip, key, paths, use_cache):
+    """Generates (or fetches) one dossier and writes each requested format. Returns (dossier, seconds, model notes)."""
+    notes = []
+    started = time.monotonic()
+    dossier = engine.generate_dossier(trip, on_event=lambda kind, name, payload: kind == "note" and notes.append(payload), use_cache=use_cache)
+    for fmt, path in paths.items():
+        if fmt == "md":
+            write_atomic(path, engine.dossier_to_markdown(dossier))
+        else:
+            write_atomic(path, json.dumps({"key": key, "trip": trip, "dossier": dossier}, ensure_ascii=False, indent=2))
+    return dossier, time.monotonic() - started, notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("specs", help="trip catalogue: .csv with a header row, or JSON lines")
+    parser.add_argument("--out", required=True, metavar="DIR", help="directory for dossiers and manifest.jsonl")
+    parser.add_argument("--format", default="md,json", help="comma-separated output formats: md, json (default: both)")
+    parser.add_argument("--concurrency", type=int, default=4, help="trips generated at once (default: 4)")
+    parser.add_argument("--rate-limit", type=float, default=0, metavar="RPM",
+                        help="max Gemini calls per minute across all trips, fallback attempts included (default: TRAVEL_PLANNER_QUOTAS)")
+    parser.add_argument("--force", action="store_true", help="regenerate trips that already have output files or a cached dossier")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Streamlit secrets file for missing keys")
+    args = parser.parse_args()
+
+    formats = [fmt.strip() for fmt in args.format.split(",") if fmt.strip()]
+    if not formats or any(fmt not in FORMATS for fmt in formats):
+        parser.error(f"--format takes a comma-separated subset of: {', '.join(FORMATS)}")
+    keys = load_keys(args.secrets)
+    if not keys["google"]:
+        parser.error("no Google API key: set GOOGLE_API_KEY or add it to the secrets file")
+    engine.configure_keys(**keys)
+    if args.rate_limit:
+        engine.get_quota_scheduler().set_quota("gemini", args.rate_limit)
+    os.makedirs(args.out, exist_ok=True)
+    manifest = Manifest(os.path.join(args.out, "manifest.jsonl"))
+
+    # Validate everything up front, so a typo on line 900 fails before line 1 spends any quota
+    jobs, seen, failures = [], set(), 0
+    for line, raw in read_specs(args.specs):
+        try:
+            trip = engine.normalize_trip(json.loads(raw) if isinstance(raw, str) else raw)
+        except (ValueError, AttributeError) as e:
+            print(f"{args.specs}:{line}: skipped, {e}", file=sys.stderr)
+            failures += 1
+            continue
+        key = engine.trip_key(trip)
+        if key in seen:
+            continue
+        seen.add(key)
+        stem = output_stem(trip, key)
+        paths = {fmt: os.path.join(args.out, f"{stem}.{fmt}") for fmt in formats}
+        if not args.force and all(os.path.exists(path) for path in paths.values()):
+            continue
+        jobs.append((trip, key, paths))
+
+    print(f"{len(jobs)} trips to generate ({len(seen) - len(jobs)} already on disk)", file=sys.stderr)
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = {pool.submit(run_trip, trip, key, paths, not args.force): (trip, key, paths) for trip, key, paths in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            trip, key, paths = futures[future]
+            done += 1
+            label = f"[{done}/{len(jobs)}] {trip['destination']} ({trip['days']}d)"
+            try:
+                _, seconds, notes = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{label} failed: {e}", file=sys.stderr)
+                manifest.record(key=key, trip=trip, status="error", error=str(e)[:500])
+                continue
+            print(f"{label} done in {seconds:.1f}s" + (f" ({len(notes)} model fallbacks)" if notes else ""), file=sys.stderr)
+            manifest.record(key=key, trip=trip, status="ok", seconds=round(seconds, 3), files=sorted(os.path.basename(p) for p in paths.values()))
+
+    engine.get_image_cache().flush()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,568 @@
+"""Offline end-to-end benchmark: the real generation flow against local stub providers.
+
+One local stub server speaks just enough of the Gemini REST API (including SSE streaming), Unsplash
+search, the MediaWiki query API and SerpApi Google Images. Real app.py sessions are driven through
+Streamlit's AppTest against it: agno, google-genai, the task graph, the image waterfall and every cache
+run unmodified, only the endpoints are local. Each scenario (trip length x concurrent sessions) runs in
+a fresh interpreter with an empty cache directory, so caches, breaker state and peak memory never leak
+from one scenario into the next. Concurrent sessions share that interpreter, like sessions on a server.
+
+Reported per scenario:
+
+  e2e_s          click-to-rendered time per session (p50 / p90 / max / mean)
+  generate_s     the traced generate run per session
+  phases_s       per task-graph phase (itinerary, logistics, hotels, editor, *_images)
+  agents_s       per agent, including model fallbacks
+  images         places resolved, images resolved per second of wall time, tier outcomes, placeholders
+                 left unresolved in the rendered dossiers
+  peak_threads   most threads alive at once while the sessions ran
+  peak_rss_mb    peak resident memory of the scenario process (baseline_rss_mb: before the clicks)
+  failed         sessions that ended without a dossier (injected errors can exhaust every model)
+  stub_requests  requests each stub provider served
+
+With --same-trip every session asks for the identical trip at once (a trending destination spike); those
+scenarios are named "d4-s4-same" and show how much upstream work concurrent identical requests share.
+
+Usage:
+    python benchmarks/bench_e2e.py                                  # 1/4/14-day trips, 1 and 4 sessions
+    python benchmarks/bench_e2e.py --days 7 --sessions 1,8 --llm-latency lognormal:3:0.4
+    python benchmarks/bench_e2e.py --llm-error-rate 0.1 --image-error-rate 0.05 --json e2e.json
+    python benchmarks/bench_e2e.py --days 4 --sessions 8 --same-trip
+    python benchmarks/bench_e2e.py --check thresholds.json          # exit 1 on a regression
+
+Latency distributions are "const:S", "uniform:LO:HI" or "lognormal:MEDIAN:SIGMA", in seconds.
+TRAVEL_PLANNER_* variables (e.g. TRAVEL_PLANNER_IMAGE_HEDGING=0) are passed through to the app.
+
+A threshold file maps a scenario name ("d4-s1") or "*" to dotted metric paths and bounds:
+    {"*": {"e2e_s.p90": {"max": 20}, "failed": {"max": 0}}, "d14-s4": {"images.per_s": {"min": 30}}}
+"""
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import math
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from bench_startup import REPO_ROOT, seed_trending
+
+APP_PATH = os.path.join(REPO_ROOT, "app.py")
+
+
+# --- STUB PROVIDERS ---
+def parse_distribution(spec):
+    """"const:S" | "uniform:LO:HI" | "lognormal:MEDIAN:SIGMA" -> fn(rng) -> seconds."""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "const" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(*values)
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise argparse.ArgumentTypeError(f"bad latency distribution: {spec!r}")
+
+
+def parse_hit_rates(spec):
+    rates = {}
+    for item in filter(None, spec.split(",")):
+        tier, _, rate = item.partition("=")
+        rates[tier.strip()] = float(rate)
+    return rates
+
+
+class StubProviders:
+    """Knobs and counters shared by every stub request: latencies, error rates, hit rates, request counts.
+
+    Whether a tier has an image for a query is a stable hash of (seed, tier, query), so repeated runs
+    and concurrent sessions see the same answers; latencies and injected errors come from a seeded RNG.
+    """
+
+    def __init__(self, args):
+        self.seed = args.seed
+        self.llm_latency = args.llm_latency
+        self.llm_chunks = args.llm_chunks
+        self.llm_error_rate = args.llm_error_rate
+        self.llm_rate_limit_rate = args.llm_rate_limit_rate
+        self.image_latency = args.image_latency
+        self.image_error_rate = args.image_error_rate
+        self.hit_rates = args.hit_rates
+        self.placeholders_per_day = args.placeholders_per_day
+        self._rng = random.Random(args.seed)
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()
+
+    def sample(self, distribution):
+        with self._lock:
+            return max(0.0, distribution(self._rng))
+
+    def roll(self, rate):
+        with self._lock:
+            return self._rng.random() < rate
+
+    def has_image(self, tier, query):
+        digest = hashlib.sha1(f"{self.seed}:{tier}:{query.lower()}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:4], "big") / 2 ** 32 < self.hit_rates.get(tier, 0.0)
+
+    def count(self, provider):
+        with self._lock:
+            self.requests[provider] += 1
+
+    def take_counts(self):
+        with self._lock:
+            counts, self.requests = dict(self.requests), collections.Counter()
+        return counts
+
+
+TRIP_DAYS = re.compile(r"(\d+)-day trip")
+DESTINATION = re.compile(r"(?:trip to|hotels in|logistics for|traveling to) (.+?)(?: in [A-Z][a-z]{2}\.| that fit|\.\s*$|\.\n)")
+FILLER = ("A short, engaging description written by the stub model so the rendered dossier has realistic "
+          "paragraph sizes without calling a real LLM. ")
+
+
+def stub_dossier_section(role, prompt, placeholders_per_day):
+    """Markdown in the layout each agent's instructions ask for, with [REAL_IMG] placeholders."""
+    days = TRIP_DAYS.search(prompt)
+    days = int(days.group(1)) if days else 3
+    destination = DESTINATION.search(prompt)
+    destination = destination.group(1) if destination else "Benchtown"
+    if role == "itinerary":
+        parts = [f"Your {days}-day plan for {destination}.\n"]
+        for day in range(1, days + 1):
+            parts.append(f"\n## Day {day}: Stub Theme {day}\n")
+            for stop in range(1, placeholders_per_day + 1):
+                place = f"{destination} Sight {day}.{stop}"
+                parts.append(f"### 📍 {place}\n**⏱️ Suggested Time:** 2 hours\n<br><br>\n"
+                             f"<img src=\"[REAL_IMG: {place}, {destination}]\">\n<br><br>\n*{FILLER * 2}*\n"
+                             f"> 🚊 **Transit to next location:** 15 mins by subway\n\n")
+        return "".join(parts)
+    if role == "hotels":
+        return "".join(f"### 🏨 Stub Hotel {i}\n<br><br>\n<img src=\"[REAL_IMG: Stub Hotel {i}, {destination}]\">\n<br><br>\n*{FILLER}*\n\n"
+                       for i in range(1, 4))
+    if role == "logistics":
+        return "".join(f"- **{topic}:** {FILLER}\n" for topic in ["Flight & Airports", "Weather", "Transport", "Etiquette"])
+    if role == "trend_scout":
+        return json.dumps([{"destination": "Benchtown, Stubland", "description": "Fast, offline and always sunny"}])
+    return FILLER * 3
+
+
+AGENT_NAMES = {"Itinerary Planner": "itinerary", "Logistics Expert": "logistics", "Hotel Concierge": "hotels",
+               "Chief Editor": "editor", "Trend Scout": "trend_scout"}
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, so the app's connection pooling behaves as it would in production
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stubs = self.server.stubs
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        provider = url.path.strip("/").split("/")[0]
+        if provider == "_reset":   # the scenario process calls this after its warm-up run
+            stubs.take_counts()
+            self._send_json(200, {})
+            return
+        if provider not in ("unsplash", "wikipedia", "serpapi"):
+            self.send_error(404)
+            return
+        stubs.count(provider)
+        time.sleep(stubs.sample(stubs.image_latency))
+        if stubs.roll(stubs.image_error_rate):
+            self._send_json(500, {"error": "injected failure"})
+            return
+
+        if provider == "unsplash":
+            query = params.get("query", "")
+            hit = stubs.has_image("unsplash", query)
+            self._send_json(200, {"results": [{"urls": {"regular": f"https://stub.invalid/unsplash/{urllib.parse.quote(query)}.jpg"}}] if hit else []})
+        elif provider == "serpapi":
+            query = params.get("q", "")
+            hit = stubs.has_image("serpapi", query)
+            self._send_json(200, {"images_results": [{"original": f"https://stub.invalid/serpapi/{urllib.parse.quote(query)}.jpg"}] if hit else []})
+        elif params.get("list") == "search":
+            self._send_json(200, {"query": {"search": []}})
+        else:
+            pages = {}
+            for i, title in enumerate(filter(None, params.get("titles", "").split("|"))):
+                if stubs.has_image("wikipedia", title):
+                    pages[str(i + 1)] = {"pageid": i + 1, "title": title,
+                                         "thumbnail": {"source": f"https://stub.invalid/wikipedia/{urllib.parse.quote(title)}.jpg"}}
+                else:
+                    pages[str(-i - 1)] = {"title": title, "missing": ""}
+            self._send_json(200, {"query": {"pages": pages}})
+
+    def do_POST(self):
+        stubs = self.server.stubs
+        path = urllib.parse.urlsplit(self.path).path
+        match = re.match(r"^/gemini/[^/]+/models/([^:]+):(generateContent|streamGenerateContent)$", path)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": "unknown stub route", "status": "NOT_FOUND"}})
+            return
+        stubs.count("gemini")
+        model, method = match.groups()
+        if stubs.roll(stubs.llm_rate_limit_rate):
+            self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted (stub).", "status": "RESOURCE_EXHAUSTED"}})
+            return
+        if stubs.roll(stubs.llm_error_rate):
+            self._send_json(503, {"error": {"code": 503, "message": "The model is overloaded (stub).", "status": "UNAVAILABLE"}})
+            return
+
+        system = " ".join(part.get("text", "") for part in body.get("systemInstruction", {}).get("parts", []))
+        prompt = " ".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+        role = next((role for name, role in AGENT_NAMES.items() if name in system), "editor")
+        text = stub_dossier_section(role, prompt, stubs.placeholders_per_day)
+        latency = stubs.sample(stubs.llm_latency)
+        usage = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4, "totalTokenCount": (len(prompt) + len(text)) // 4}
+
+        def chunk(piece, last):
+            candidate = {"content": {"role": "model", "parts": [{"text": piece}]}, "index": 0}
+            if last:
+                candidate["finishReason"] = "STOP"
+            return {"candidates": [candidate], "usageMetadata": usage, "modelVersion": model}
+
+        if method == "generateContent":
+            time.sleep(latency)
+            self._send_json(200, chunk(text, True))
+            return
+
+        # Server-sent events, with the sampled latency spread evenly over the chunks
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        size = max(1, math.ceil(len(text) / stubs.llm_chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for i, piece in enumerate(pieces):
+            time.sleep(latency / len(pieces))
+            self.wfile.write(b"data: " + json.dumps(chunk(piece, i == len(pieces) - 1)).encode("utf-8") + b"\r\n\r\n")
+            self.wfile.flush()
+
+
+def start_stub_server(stubs):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.stubs = stubs
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+
+# --- SCENARIO PROCESS ---
+class ResourceMonitor(threading.Thread):
+    """Samples thread count and resident memory every few milliseconds while the sessions run."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(name="resource-monitor", daemon=True)
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # Linux reports KiB; peak only
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _share_apptest_runtime():
+    """AppTest assumes one app per process: every run installs, then clears, a global mock Runtime and
+    recompiles the script. Install one Runtime and one script cache for every session instead, which is
+    also what a real server does, so concurrent sessions can run side by side."""
+    from unittest.mock import MagicMock
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    import streamlit.testing.v1.app_test as app_test
+    import streamlit.testing.v1.local_script_runner as local_script_runner
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    app_test.Runtime = type("SharedRuntime", (), {"_instance": None})   # AppTest's own install/clear becomes a no-op
+    config.get_config_options()
+    config._set_option("global.appTest", True, "bench")                  # so overlapping runs never restore it to False
+
+    script_cache = local_script_runner.ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+    app_test.ScriptCache = lambda: script_cache
+
+
+def _new_session(destination, days):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=900)
+    for key in ("GOOGLE_API_KEY", "SERPAPI_KEY", "UNSPLASH_API_KEY"):
+        at.secrets[key] = "bench"
+    at.run()
+    at.sidebar.text_input[0].input(destination)
+    at.sidebar.number_input[0].set_value(days)
+    return at
+
+
+def run_scenario(days, sessions, warmup, same_trip=False):
+    """Runs in the scenario's own interpreter; prints one JSON line of session timings and resource peaks."""
+    import logging
+    import urllib.request
+    logging.disable(logging.CRITICAL)
+    _share_apptest_runtime()
+
+    if warmup:
+        # One throwaway trip pays the one-off costs (agno import, client setup) so the sessions measure a warm server
+        _new_session("Warmup Town", 1).sidebar.button[0].click().run()
+        open(os.environ["TRAVEL_PLANNER_TRACE_LOG"], "w").close()
+        urllib.request.urlopen(os.environ["BENCH_STUB_URL"] + "/_reset").read()
+
+    apps = [_new_session("Benchtown" if same_trip else f"Benchtown {i + 1}", days) for i in range(sessions)]
+
+    monitor = ResourceMonitor()
+    baseline_rss = monitor.rss_bytes()
+    results = [None] * sessions
+    barrier = threading.Barrier(sessions)
+
+    def session(i):
+        barrier.wait()
+        started = time.perf_counter()
+        try:
+            at = apps[i].sidebar.button[0].click().run()
+        except Exception as e:
+            results[i] = {"ok": False, "e2e_s": time.perf_counter() - started, "error": str(e)[:300]}
+            return
+        dossier_id = at.session_state["dossier_id"] if "dossier_id" in at.session_state else None # the dossier itself lives in the shared store
+        results[i] = {
+            "ok": not at.exception and dossier_id is not None,
+            "e2e_s": time.perf_counter() - started,
+            "unresolved": sum(m.value.count("[REAL_IMG") for m in at.markdown),
+            "error": str(at.exception[0].value)[:300] if at.exception else None,
+        }
+
+    monitor.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(i,), name=f"session-{i}") for i in range(sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    monitor.stop()
+    print(json.dumps({"sessions": results, "wall_s": wall, "peak_threads": monitor.peak_threads,
+                      "peak_rss_mb": monitor.peak_rss / 2 ** 20, "baseline_rss_mb": baseline_rss / 2 ** 20}))
+
+
+# --- AGGREGATION ---
+def summarize(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "p50": statistics.median(ordered),
+        "p90": ordered[min(len(ordered) - 1, math.ceil(0.9 * len(ordered)) - 1)],
+        "max": ordered[-1],
+        "mean": statistics.fmean(ordered),
+        "n": len(ordered),
+    }
+
+
+def summarize_trace(trace_path):
+    """Per-phase / per-agent latencies and image-tier outcomes from the app's own span log."""
+    spans = []
+    if os.path.exists(trace_path):
+        with open(trace_path, encoding="utf-8") as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+    durations = collections.defaultdict(lambda: collections.defaultdict(list))
+    tiers = collections.defaultdict(collections.Counter)
+    resolved = cache_hits = 0
+    for span in spans:
+        elapsed = span["end"] - span["start"]
+        if span["kind"] in ("run", "phase", "agent"):
+            durations[span["kind"]][span["name"]].append(elapsed)
+        elif span["kind"] == "images":
+            resolved += span["attrs"].get("queries", 0)
+            cache_hits += span["attrs"].get("cache_hits", 0)
+        elif span["kind"] == "image_tier":
+            tiers[span["name"]][span["status"]] += 1
+    return {
+        "generate_s": summarize(durations["run"].get("generate", [])),
+        "phases_s": {name: summarize(values) for name, values in sorted(durations["phase"].items())},
+        "agents_s": {name: summarize(values) for name, values in sorted(durations["agent"].items())},
+        "images": {"resolved": resolved, "cache_hits": cache_hits, "tiers": {tier: dict(c) for tier, c in sorted(tiers.items())}},
+    }
+
+
+def measure(days, sessions, stubs, base_url, timeout, warmup=True, same_trip=False):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        seed_trending(cache_dir)
+        trace_path = os.path.join(cache_dir, "trace.jsonl")
+        env = dict(os.environ,
+                   TRAVEL_PLANNER_CACHE_DIR=cache_dir,
+                   TRAVEL_PLANNER_TRACE_LOG=trace_path,
+                   TRAVEL_PLANNER_METRICS_PORT="",
+                   BENCH_STUB_URL=base_url,
+                   GOOGLE_GEMINI_BASE_URL=f"{base_url}/gemini",
+                   TRAVEL_PLANNER_UNSPLASH_API=f"{base_url}/unsplash/search/photos",
+                   TRAVEL_PLANNER_WIKIPEDIA_API=f"{base_url}/wikipedia/w/api.php",
+                   TRAVEL_PLANNER_SERPAPI_API=f"{base_url}/serpapi/search.json")
+        stubs.take_counts()
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-scenario", f"{days},{sessions},{int(warmup)},{int(same_trip)}"],
+                             capture_output=True, text=True, env=env, cwd=REPO_ROOT, timeout=timeout)
+        if out.returncode != 0:
+            raise SystemExit(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "scenario failed")
+        raw = json.loads(out.stdout.strip().splitlines()[-1])
+        traced = summarize_trace(trace_path)
+
+    ok = [s for s in raw["sessions"] if s and s["ok"]]
+    row = {
+        "name": f"d{days}-s{sessions}" + ("-same" if same_trip else ""),
+        "days": days,
+        "sessions": sessions,
+        "warmup": warmup,
+        "same_trip": same_trip,
+        "failed": sessions - len(ok),
+        "error_rate": (sessions - len(ok)) / sessions,
+        "errors": sorted({s["error"] for s in raw["sessions"] if s and s.get("error")}),
+        "e2e_s": summarize([s["e2e_s"] for s in ok]),
+        "wall_s": raw["wall_s"],
+        "peak_threads": raw["peak_threads"],
+        "peak_rss_mb": raw["peak_rss_mb"],
+        "baseline_rss_mb": raw["baseline_rss_mb"],
+        "stub_requests": stubs.take_counts(),
+    }
+    row.update(traced)
+    row["images"]["per_s"] = row["images"]["resolved"] / raw["wall_s"] if raw["wall_s"] else 0.0
+    row["images"]["unresolved_placeholders"] = sum(s.get("unresolved", 0) for s in raw["sessions"] if s)
+    return row
+
+
+# --- REGRESSION THRESHOLDS ---
+def metric(row, path):
+    value = row
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def check_thresholds(rows, thresholds):
+    """Returns a list of human-readable violations ("d4-s1 e2e_s.p90 = 21.3 > max 20")."""
+    violations = []
+    for row in rows:
+        for scope in ("*", row["name"]):
+            for path, bounds in thresholds.get(scope, {}).items():
+                value = metric(row, path)
+                if value is None:
+                    violations.append(f"{row['name']} {path} missing")
+                    continue
+                if "max" in bounds and value > bounds["max"]:
+                    violations.append(f"{row['name']} {path} = {value:.4g} > max {bounds['max']}")
+                if "min" in bounds and value < bounds["min"]:
+                    violations.append(f"{row['name']} {path} = {value:.4g} < min {bounds['min']}")
+    return violations
+
+
+def _int_list(spec):
+    return [int(x) for x in spec.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=_int_list, default=[1, 4, 14], help="trip lengths, 1-14 (default: 1,4,14)")
+    parser.add_argument("--sessions", type=_int_list, default=[1, 4], help="concurrent sessions (default: 1,4)")
+    parser.add_argument("--llm-latency", type=parse_distribution, default=parse_distribution("lognormal:2.0:0.35"),
+                        metavar="DIST", help="time per model call (default: lognormal:2.0:0.35)")
+    parser.add_argument("--llm-chunks", type=int, default=40, help="SSE chunks per streamed response (default: 40)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of model calls failing with 503")
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0, help="share of model calls failing with 429")
+    parser.add_argument("--image-latency", type=parse_distribution, default=parse_distribution("lognormal:0.15:0.5"),
+                        metavar="DIST", help="time per image-provider request (default: lognormal:0.15:0.5)")
+    parser.add_argument("--image-error-rate", type=float, default=0.0, help="share of image requests failing with 500")
+    parser.add_argument("--hit-rates", type=parse_hit_rates, default=parse_hit_rates("unsplash=0.3,wikipedia=0.5,serpapi=0.9"),
+                        metavar="TIER=P,...", help="chance each tier has an image (default: unsplash=0.3,wikipedia=0.5,serpapi=0.9)")
+    parser.add_argument("--placeholders-per-day", type=int, default=3, help="[REAL_IMG] places per itinerary day (default: 3)")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false",
+                        help="time the first generation in a fresh process too (includes the one-off agno import)")
+    parser.add_argument("--same-trip", action="store_true", help="every session requests the identical trip at the same moment")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds before a scenario is abandoned")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    parser.add_argument("--check", metavar="PATH", help="threshold file; exit 1 if any bound is violated")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        days, sessions, warmup, same_trip = _int_list(args.run_scenario)
+        run_scenario(days, sessions, bool(warmup), bool(same_trip))
+        return
+    if any(not 1 <= d <= 14 for d in args.days):
+        parser.error("--days must be between 1 and 14 (the app's own limit)")
+
+    stubs = StubProviders(args)
+    server = start_stub_server(stubs)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    rows = []
+    try:
+        for days, sessions in itertools.product(args.days, args.sessions):
+            row = measure(days, sessions, stubs, base_url, args.timeout, args.warmup, args.same_trip)
+            rows.append(row)
+            e2e = row["e2e_s"] or {}
+            print(f"{row['name']:>8}: e2e p50={e2e.get('p50', float('nan')):.2f}s p90={e2e.get('p90', float('nan')):.2f}s"
+                  f"  failed={row['failed']}/{sessions}  images={row['images']['resolved']} ({row['images']['per_s']:.1f}/s)"
+                  f"  threads={row['peak_threads']}  rss={row['peak_rss_mb']:.0f}MB  model_calls={row['stub_requests'].get('gemini', 0)}")
+    finally:
+        server.shutdown()
+
+    config = {key: value for key, value in vars(args).items() if key in ("llm_chunks", "llm_error_rate", "llm_rate_limit_rate",
+                                                                         "image_error_rate", "hit_rates", "placeholders_per_day", "warmup", "same_trip", "seed")}
+    config.update({key: value for key, value in os.environ.items() if key.startswith("TRAVEL_PLANNER_")})
+    config["argv"] = sys.argv[1:]
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "scenarios": rows}, f, indent=2)
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            violations = check_thresholds(rows, json.load(f))
+        for violation in violations:
+            print(f"REGRESSION {violation}")
+        if violations:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
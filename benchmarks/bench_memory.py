@@ -0,0 +1,139 @@
+"""Session memory benchmark: whole dossiers in session_state vs. ids into the shared dossier store.
+
+Each scenario runs in a fresh interpreter. It builds realistic dossiers with engine.build_dossier (long
+itineraries, one photo URL and a paragraph per place), then opens N sessions over T distinct trips the way
+app.py does. "inline" keeps the decoded dossier in each session's state, as the app used to: every session
+that loads a trip gets its own copy, even of a popular one. "store" keeps only the id and reads go through
+engine.DossierStore (decoded / compressed memory / disk tiers). Then R renders hit random sessions.
+
+Reported per scenario and mode:
+
+  retained_mb     memory still held once every session is open (tracemalloc, after gc), what stays
+                  resident until sessions expire
+  per_session_kb  retained_mb spread over the sessions
+  peak_mb         traced peak while the sessions were opened and rendered
+  read_ms         time to get a session's dossier for a render (p50 / p99): a dict lookup for inline,
+                  a store hit or a decompression for store
+  store           the store's tier counters after the renders
+
+Usage:
+    python benchmarks/bench_memory.py                            # 100 and 250 sessions, 14-day trips
+    python benchmarks/bench_memory.py --sessions 500 --trips 50  # a popular-destination spike
+    python benchmarks/bench_memory.py --days 7 --json memory.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = r"""
+import gc, json, random, sys, time, tracemalloc
+import engine
+
+mode, sessions, trips, days, renders = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+rng = random.Random(1)
+WORDS = ("old town harbour market quiet lane temple museum sunset ferry tasting menu local guide hidden courtyard "
+         "terrace early train station rooftop gallery walk river garden bakery tram district view evening").split()
+
+def paragraph(n):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+def photo():
+    return (f'<img src="https://images.unsplash.com/photo-{rng.randrange(10**12, 10**13)}-{rng.randrange(16**12):012x}'
+            f'?crop=entropy&cs=tinysrgb&fit=max&fm=jpg&ixid=M3w{rng.randrange(16**40):040x}&ixlib=rb-4.0.3&q=80&w=1080" '
+            'style="width:100%; border-radius:10px; margin-bottom:12px;">')
+
+def dossier(trip):
+    itinerary = paragraph(60) + "\n"
+    for day in range(1, days + 1):
+        itinerary += f"## Day {day}: {paragraph(4)[:-1]}\n"
+        for place in range(4):
+            itinerary += f"### 📍 Place {trip}-{day}-{place}\n{photo()}\n{paragraph(90)}\n\n"
+    hotels = "".join(f"### 🏨 Hotel {trip}-{h}\n{photo()}\n{paragraph(70)}\n\n" for h in range(3))
+    logistics = "\n".join(f"- **{paragraph(2)[:-1]}:** {paragraph(40)}" for _ in range(8))
+    return engine.build_dossier(paragraph(120), itinerary, hotels, logistics)
+
+# What the trip cache hands out; allocated before tracing starts, it is the same for both modes
+payloads = [json.dumps(dossier(t)) for t in range(trips)]
+store = engine.get_dossier_store()
+gc.collect()
+tracemalloc.start()
+base = tracemalloc.get_traced_memory()[0]
+
+states = []
+for s in range(sessions):
+    loaded = json.loads(payloads[s % trips])   # cached_dossier(): a fresh object for every session
+    if mode == "inline":
+        states.append({"itinerary_data": loaded, "trip_params": {"days": days}})
+    else:
+        states.append({"dossier_id": store.put(loaded), "trip_params": {"days": days}})
+    del loaded
+
+reads = []
+for _ in range(renders):
+    state = rng.choice(states)
+    started = time.perf_counter()
+    current = state["itinerary_data"] if mode == "inline" else store.get(state["dossier_id"])
+    reads.append(time.perf_counter() - started)
+    assert current["days"]
+del current
+gc.collect()
+retained, peak = tracemalloc.get_traced_memory()
+reads.sort()
+print(json.dumps({
+    "mode": mode, "sessions": sessions, "trips": trips,
+    "dossier_kb": round(len(payloads[0]) / 1024, 1),
+    "retained_mb": round((retained - base) / 1e6, 2),
+    "per_session_kb": round((retained - base) / sessions / 1024, 1),
+    "peak_mb": round((peak - base) / 1e6, 2),
+    "read_ms": {"p50": round(reads[len(reads) // 2] * 1000, 4), "p99": round(reads[int(0.99 * (len(reads) - 1))] * 1000, 4)},
+    "store": store.stats() if mode == "store" else None,
+}))
+"""
+
+
+def run_mode(mode, sessions, trips, days, renders):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, TRAVEL_PLANNER_CACHE_DIR=cache_dir, GOOGLE_API_KEY="")
+        out = subprocess.run([sys.executable, "-c", _PROBE, mode, str(sessions), str(trips), str(days), str(renders)],
+                             capture_output=True, text=True, env=env, cwd=REPO_ROOT)
+    if out.returncode != 0:
+        raise SystemExit(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "probe failed")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _int_list(spec):
+    return [int(part) for part in spec.split(",") if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=_int_list, default=[100, 250], help="open sessions per scenario (default: 100,250)")
+    parser.add_argument("--trips", type=int, default=0, help="distinct trips shared by the sessions (default: one per session)")
+    parser.add_argument("--days", type=int, default=14, help="trip length (default: 14)")
+    parser.add_argument("--renders", type=int, default=2000, help="renders of random sessions (default: 2000)")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for sessions in args.sessions:
+        trips = min(args.trips or sessions, sessions)
+        for mode in ("inline", "store"):
+            row = run_mode(mode, sessions, trips, args.days, args.renders)
+            results.append(row)
+            print(f"{mode:>6} s{sessions}-t{trips}: retained={row['retained_mb']:.2f}MB ({row['per_session_kb']:.1f}KB/session, "
+                  f"dossier {row['dossier_kb']}KB as JSON)  peak={row['peak_mb']:.2f}MB  "
+                  f"read p50={row['read_ms']['p50']:.3f}ms p99={row['read_ms']['p99']:.3f}ms")
+        inline, store = results[-2], results[-1]
+        print(f"        store keeps {store['retained_mb'] / inline['retained_mb']:.1%} of inline memory")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
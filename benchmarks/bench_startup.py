@@ -0,0 +1,139 @@
+"""Startup / rerun timing benchmark for app.py.
+
+Runs the landing page headlessly with Streamlit's AppTest (no browser, no API keys) and reports:
+
+  cold_run_s       first script run in a fresh interpreter (includes every import app.py triggers)
+  rerun_median_s   median of N warm reruns in the same process (what each widget interaction costs)
+  agno_import_s    one-off cost of the agno / Gemini / SerpApi imports, now deferred to generation
+  agent_setup_*    building every role's agent with engine's factory vs. fetching them through engine.get_agent
+                   (current tree only)
+
+--compare checks the whole tree out at REV in a temporary git worktree, so app.py and engine.py match.
+
+Usage:
+    python benchmarks/bench_startup.py                  # current working tree
+    python benchmarks/bench_startup.py --compare HEAD~1 # before/after against any git revision
+    python benchmarks/bench_startup.py --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Executed in a fresh interpreter per app variant so import costs are real, not already cached in sys.modules
+_PROBE = r"""
+import json, logging, os, statistics, sys, time
+logging.disable(logging.CRITICAL)
+from streamlit.testing.v1 import AppTest
+import streamlit.testing.v1.local_script_runner as local_script_runner
+
+# The real server compiles app.py once and reuses the bytecode; AppTest would recompile it on every run
+_shared_script_cache = local_script_runner.ScriptCache()
+local_script_runner.ScriptCache = lambda: _shared_script_cache
+
+app_path, reruns = sys.argv[1], int(sys.argv[2])
+at = AppTest.from_file(app_path, default_timeout=120)
+started = time.perf_counter()
+at.run()
+cold = time.perf_counter() - started
+if at.exception:
+    raise SystemExit(f"app raised: {at.exception}")
+
+samples = []
+for _ in range(reruns):
+    started = time.perf_counter()
+    at.run()
+    samples.append(time.perf_counter() - started)
+
+print(json.dumps({"cold_run_s": cold, "rerun_median_s": statistics.median(samples), "rerun_p90_s": sorted(samples)[int(0.9 * (len(samples) - 1))]}))
+"""
+
+_AGENT_PROBE = r"""
+import json, logging, sys, time
+logging.disable(logging.CRITICAL)
+import engine
+
+engine.configure_keys(google="bench", serpapi="bench")
+started = time.perf_counter()
+engine._agno_classes()
+import_s = time.perf_counter() - started
+
+roles, model_id = list(engine.AGENT_ROLES), engine.FALLBACK_MODELS[0]
+build = engine._build_agent.__wrapped__   # the factory behind get_agent's process-wide cache
+rounds = int(sys.argv[1])
+started = time.perf_counter()
+for _ in range(rounds):
+    [build(role, model_id, engine._keys_fingerprint()) for role in roles]
+uncached = (time.perf_counter() - started) / rounds
+
+[engine.get_agent(role, model_id) for role in roles]
+started = time.perf_counter()
+for _ in range(rounds):
+    [engine.get_agent(role, model_id) for role in roles]
+hit = (time.perf_counter() - started) / rounds
+
+print(json.dumps({"agno_import_s": import_s, "agent_setup_uncached_ms": uncached * 1000, "agent_setup_cached_ms": hit * 1000}))
+"""
+
+
+def _run_probe(code, *args, cache_dir, cwd=REPO_ROOT):
+    env = dict(os.environ, TRAVEL_PLANNER_CACHE_DIR=cache_dir, GOOGLE_API_KEY="")
+    # The probe's working directory is on its sys.path, so `import engine` in app.py resolves next to app.py
+    out = subprocess.run([sys.executable, "-c", code, *map(str, args)], capture_output=True, text=True, env=env, cwd=cwd)
+    if out.returncode != 0:
+        raise SystemExit(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "probe failed")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def seed_trending(cache_dir):
+    """Fresh trends on disk, so the landing page never calls out to Gemini during the benchmark."""
+    with open(os.path.join(cache_dir, "trending.json"), "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": time.time(), "destinations": [
+            {"destination": "Tokyo, Japan", "description": "bench", "image_url": "https://example.invalid/tokyo.jpg"},
+        ]}, f)
+
+
+def measure_app(app_path, reruns):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        seed_trending(cache_dir)
+        return _run_probe(_PROBE, app_path, reruns, cache_dir=cache_dir, cwd=os.path.dirname(app_path))
+
+
+def measure_revision(rev, reruns):
+    """measure_app on a detached worktree of the whole tree at rev, removed afterwards."""
+    with tempfile.TemporaryDirectory() as workdir:
+        tree = os.path.join(workdir, "tree")
+        subprocess.run(["git", "worktree", "add", "--detach", tree, rev], capture_output=True, cwd=REPO_ROOT, check=True)
+        try:
+            return measure_app(os.path.join(tree, "app.py"), reruns)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", tree], capture_output=True, cwd=REPO_ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reruns", type=int, default=20, help="warm reruns to sample (default: 20)")
+    parser.add_argument("--compare", metavar="REV", help="also measure the tree at this git revision")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = {"current": measure_app(os.path.join(REPO_ROOT, "app.py"), args.reruns)}
+    if args.compare:
+        results[args.compare] = measure_revision(args.compare, args.reruns)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        results["agents"] = _run_probe(_AGENT_PROBE, 50, cache_dir=cache_dir)
+
+    for name, row in results.items():
+        print(f"{name:>12}: " + "  ".join(f"{key}={value:.4f}" for key, value in row.items()))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3083 @@
+"""Headless travel-dossier engine: agents, image waterfall, caches and the generation pipeline.
+
+Everything here runs without Streamlit. app.py renders what iter_generation() reports, and batch.py
+drives generate_dossier() for whole catalogues of trips. Caches, pools and breakers are process-wide
+singletons, shared by every Streamlit session or batch worker in the process.
+"""
+import os
+import urllib.parse
+import json
+import re
+import time
+import tempfile
+import threading
+import collections
+import contextlib
+import contextvars
+import functools
+import itertools
+import hashlib
+import heapq
+import ipaddress
+import socket
+import hmac
+import base64
+import io
+import html
+import zipfile
+import zlib
+import queue
+import concurrent.futures
+import http.server
+import requests
+import requests.adapters
+
+# --- CONFIGURATION & PROCESS-WIDE RESOURCES ---
+API_KEYS = {
+    "google": os.environ.get("GOOGLE_API_KEY", ""),
+    "serpapi": os.environ.get("SERPAPI_KEY", ""),
+    "unsplash": os.environ.get("UNSPLASH_API_KEY", ""),
+}
+
+
+def configure_keys(google=None, serpapi=None, unsplash=None):
+    """Sets the provider keys (the app passes its Streamlit secrets on every run; a change retires cached agents)."""
+    for name, value in (("google", google), ("serpapi", serpapi), ("unsplash", unsplash)):
+        if value is not None:
+            API_KEYS[name] = value
+
+
+def process_resource(max_entries=None):
+    """st.cache_resource without Streamlit: one instance per distinct arguments for the life of the process.
+
+    Instances are built under a lock, so concurrent first callers share one instead of racing; beyond
+    max_entries the least recently used is dropped.
+    """
+    def decorate(factory):
+        lock = threading.RLock()
+        instances = collections.OrderedDict()
+
+        @functools.wraps(factory)
+        def get(*args):
+            with lock:
+                if args in instances:
+                    instances.move_to_end(args)
+                    return instances[args]
+                instance = instances[args] = factory(*args)
+                while max_entries and len(instances) > max_entries:
+                    instances.popitem(last=False)
+                return instance
+        return get
+    return decorate
+
+
+class InFlight:
+    """Single-flight registry: while one caller works on a key, concurrent callers of the same key wait on its
+    Future instead of repeating the work. Keys leave the registry as soon as they are settled."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+        self.coalesced = 0
+
+    def claim(self, keys):
+        """Returns (owned, joined): the keys this caller must settle, and {key: Future} for keys already in flight."""
+        owned, joined = [], {}
+        with self._lock:
+            for key in keys:
+                if key in owned:
+                    continue   # a repeat of a key this caller already owns is not a coalesced request
+                if key in self._futures:
+                    joined[key] = self._futures[key]
+                else:
+                    self._futures[key] = concurrent.futures.Future()
+                    owned.append(key)
+            self.coalesced += len(joined)
+        return owned, joined
+
+    def settle(self, key, result=None, error=None):
+        with self._lock:
+            future = self._futures.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+# --- PERSISTENT IMAGE LOOKUP CACHE ---
+CACHE_DIR = os.environ.get("TRAVEL_PLANNER_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+# How long a resolved URL stays trustworthy, per tier. "miss" is the negative cache for queries no tier could answer.
+IMAGE_CACHE_TTLS = {
+    "unsplash": 30 * 86400,
+    "wikipedia": 30 * 86400,
+    "serpapi": 7 * 86400,   # Google Images 'original' links point at third-party hosts and rot faster
+    "miss": 86400,
+}
+
+
+def normalize_image_query(query):
+    """Canonical cache key: case-folded, whitespace-collapsed, consistent comma spacing."""
+    key = " ".join(str(query).lower().split())
+    return re.sub(r"\s*,\s*", ", ", key).strip(" ,")
+
+
+class ImageCache:
+    """Thread-safe, size-bounded LRU of query -> image URL with per-tier TTLs, persisted as JSON."""
+
+    def __init__(self, path, max_entries=5000, ttls=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(IMAGE_CACHE_TTLS, **(ttls or {}))
+        self._entries = collections.OrderedDict()  # key -> {"url", "tier", "expires"}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()   # one writer at a time, so an older snapshot never lands last
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        # File is written oldest-first, so replaying it restores the LRU order
+        for key, entry in stored.get("entries", []):
+            if entry.get("expires", 0) > now:
+                self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, query):
+        """Returns the cached URL, or None on a miss/expiry. Negative entries return their failsafe URL."""
+        key = normalize_image_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] <= time.time():
+                del self._entries[key]
+                self._dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["url"]
+
+    def put(self, query, url, tier):
+        key = normalize_image_query(query)
+        ttl = self.ttls.get(tier, self.ttls["miss"])
+        with self._lock:
+            self._entries[key] = {"url": url, "tier": tier, "expires": time.time() + ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+
+    def flush(self):
+        """Writes the cache to disk if anything changed since the last flush (atomic replace)."""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = list(self._entries.items())
+                self._dirty = False
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"entries": snapshot}, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                with self._lock:
+                    self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+@process_resource()
+def get_image_cache():
+    """One cache per server process, shared by every session, thread and the trend scout."""
+    return ImageCache(os.path.join(CACHE_DIR, "image_cache.json"))
+
+
+@process_resource()
+def get_image_flights():
+    """Image queries being resolved right now, by normalized query, across every session in the process."""
+    return InFlight()
+
+
+# --- SHARED HTTP LAYER ---
+HTTP_WORKERS = int(os.environ.get("TRAVEL_PLANNER_HTTP_WORKERS", "32"))  # one pool for every session in the process
+PROVIDER_CONCURRENCY = {"unsplash": 4, "wikipedia": 8, "serpapi": 4, "images": 8}   # max in-flight requests per provider
+
+
+class HttpPool:
+    """Keep-alive requests.Session with per-host connection pools, a bounded worker pool and per-provider caps.
+
+    Provider caps are applied before work reaches the pool: a provider's jobs wait in its own queue until one of
+    its slots frees up, so pool threads only ever run requests and one busy provider cannot starve the others.
+    """
+
+    def __init__(self, workers=HTTP_WORKERS, provider_limits=None):
+        limits = dict(PROVIDER_CONCURRENCY, **(provider_limits or {}))
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'TravelPlanner/1.0'})
+        # pool_block keeps each host at pool_maxsize sockets no matter how many threads ask
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=max(limits.values()), pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        # Quota waits (see submit) happen here, never on the request pool
+        self._quota_waiters = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="http-quota")
+        self._limits = dict(limits)
+        self._running = collections.Counter()
+        self._queues = collections.defaultdict(collections.deque)   # provider -> (Future, job) waiting for a slot
+        self._lock = threading.Lock()
+        # For blocking callers on their own threads (get_bytes), which wait for a slot in place
+        self._slots = {provider: threading.BoundedSemaphore(n) for provider, n in limits.items()}
+
+    def submit(self, fn, *args, provider=None, quota=None, max_wait=None, **kwargs):
+        """Runs fn on the pool with the caller's context (its request priority). Returns a Future.
+
+        With a provider the job first waits in that provider's queue; with a quota key it first takes a token
+        from the scheduler's bucket (QuotaWaitTimeout after max_wait). Cancelling the Future drops a job still waiting.
+        """
+        job = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        if provider not in self._limits and quota is None:
+            return self.executor.submit(job)
+        future = concurrent.futures.Future()
+        if quota is None:
+            self._enqueue(provider, future, job)
+        else:
+            self._quota_waiters.submit(contextvars.copy_context().run, self._await_quota, quota, max_wait, provider, future, job)
+        return future
+
+    def _await_quota(self, key, max_wait, provider, future, job):
+        if future.cancelled():
+            return
+        try:
+            get_quota_scheduler().acquire(key, max_wait=max_wait)
+        except QuotaWaitTimeout as e:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(e)
+            return
+        self._enqueue(provider, future, job)
+
+    def _enqueue(self, provider, future, job):
+        if provider not in self._limits:
+            if future.set_running_or_notify_cancel():
+                self.executor.submit(self._run, None, future, job)
+            return
+        with self._lock:
+            self._queues[provider].append((future, job))
+        self._dispatch(provider)
+
+    def _dispatch(self, provider):
+        """Hands queued jobs to the pool while the provider has free slots."""
+        while True:
+            with self._lock:
+                if self._running[provider] >= self._limits[provider] or not self._queues[provider]:
+                    return
+                future, job = self._queues[provider].popleft()
+                self._running[provider] += 1
+            if future.set_running_or_notify_cancel():
+                self.executor.submit(self._run, provider, future, job)
+            else:
+                with self._lock:   # cancelled while queued (its race was already settled)
+                    self._running[provider] -= 1
+
+    def _run(self, provider, future, job):
+        try:
+            result = job()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            if provider is not None:
+                with self._lock:
+                    self._running[provider] -= 1
+                self._dispatch(provider)
+
+    def get_json(self, provider, url, params=None, timeout=3):
+        """GET + JSON decode. Raises on HTTP errors. The provider's cap is applied by submit(provider=...)."""
+        response = self.session.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_bytes(self, provider, url, timeout=10, max_bytes=None, allow_url=None):
+        """GET a binary body of at most max_bytes, holding one of the provider's slots. Returns (body, content type).
+
+        allow_url(url) vets the URL and every redirect hop before it is requested; a refused one raises ValueError.
+        """
+        slot = self._slots.get(provider)
+        if slot is not None and not slot.acquire(timeout=timeout):
+            raise TimeoutError(f"{provider} concurrency limit reached")
+        try:
+            for _ in range(5):
+                if allow_url is not None and not allow_url(url):
+                    raise ValueError(f"refusing to fetch {url}")
+                with self.session.get(url, timeout=timeout, stream=True, allow_redirects=False) as response:
+                    if response.is_redirect:
+                        url = urllib.parse.urljoin(url, response.headers["Location"])
+                        continue
+                    response.raise_for_status()
+                    body = bytearray()
+                    for chunk in response.iter_content(64 * 1024):
+                        body += chunk
+                        if max_bytes and len(body) > max_bytes:
+                            raise ValueError(f"image larger than {max_bytes} bytes")
+                    return bytes(body), response.headers.get("Content-Type", "")
+            raise ValueError("too many redirects")
+        finally:
+            if slot is not None:
+                slot.release()
+
+
+@process_resource()
+def get_http_pool():
+    """One HTTP pool per server process, so sockets and threads stay bounded across concurrent sessions."""
+    return HttpPool()
+
+
+# --- TRACING & METRICS ---
+TRACE_LOG = os.environ.get("TRAVEL_PLANNER_TRACE_LOG", "")              # append every finished span here as JSON lines
+METRICS_PORT = os.environ.get("TRAVEL_PLANNER_METRICS_PORT", "")        # serve /metrics and /traces.jsonl on this port
+METRICS_HOST = os.environ.get("TRAVEL_PLANNER_METRICS_HOST", "127.0.0.1")
+TRACE_MAX_TRACES = 50
+TRACE_MAX_SPANS = 5000   # per trace; a runaway trace stops recording rather than eating memory
+
+class Tracer:
+    """Process-wide span recorder and metrics registry.
+
+    A span is a plain dict (trace_id, span_id, parent_id, name, kind, start, end, status, attrs) with
+    wall-clock times. Spans opened with span() become the parent of anything started inside them,
+    including work handed to other threads through contextvars.copy_context(). Every finished span
+    also feeds two metrics keyed by (kind, name): a count per status and a latency sum.
+
+    The "current span" ContextVar lives on the instance, so independent tracers never see each other's spans.
+    """
+
+    def __init__(self, log_path=None, max_traces=TRACE_MAX_TRACES, max_spans=TRACE_MAX_SPANS):
+        self.log_path = log_path
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._traces = collections.OrderedDict()    # trace_id -> [span, ...], oldest trace first
+        self._span_counts = collections.Counter()   # (kind, name, status) -> finished spans
+        self._span_seconds = collections.Counter()  # (kind, name) -> total seconds
+        self._counters = collections.Counter()      # (metric, sorted label items) -> value
+        self.dropped_spans = 0
+        self._current = contextvars.ContextVar("travel_planner_span", default=None)
+
+    def current(self):
+        return self._current.get()
+
+    def activate(self, span):
+        """Makes an already-started span current in this context; pass the token to deactivate()."""
+        return self._current.set(span)
+
+    def deactivate(self, token):
+        self._current.reset(token)
+
+    def start_span(self, name, kind, parent=None, **attrs):
+        """Opens a span under `parent` (default: the current span; none starts a new trace)."""
+        parent = parent if parent is not None else self._current.get()
+        span_id = f"{os.getpid():x}-{next(self._ids):x}"
+        span = {
+            "trace_id": parent["trace_id"] if parent else span_id,
+            "span_id": span_id,
+            "parent_id": parent["span_id"] if parent else None,
+            "name": name,
+            "kind": kind,
+            "start": time.time(),
+            "end": None,
+            "status": None,
+            "attrs": attrs,
+        }
+        with self._lock:
+            spans = self._traces.get(span["trace_id"])
+            if spans is None:
+                spans = self._traces[span["trace_id"]] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) < self.max_spans:
+                spans.append(span)
+            else:
+                self.dropped_spans += 1
+        return span
+
+    def end_span(self, span, status=None, end=None, **attrs):
+        """Closes a span. The status defaults to whatever the span already carries, else "ok"."""
+        span["end"] = end if end is not None else time.time()
+        span["status"] = status or span["status"] or "ok"
+        span["attrs"].update(attrs)
+        with self._lock:
+            self._span_counts[(span["kind"], span["name"], span["status"])] += 1
+            self._span_seconds[(span["kind"], span["name"])] += span["end"] - span["start"]
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(span, default=str) + "\n")
+                except OSError:
+                    pass   # tracing must never break a generation
+
+    def record_span(self, name, kind, start, end, status="ok", parent=None, **attrs):
+        """Adds a span measured elsewhere (e.g. a tool call agno timed for us)."""
+        span = self.start_span(name, kind, parent=parent, **attrs)
+        span["start"] = start
+        self.end_span(span, status, end=end)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, kind, **attrs):
+        """Context manager: the span is current inside the block and ends with "error" if it raises."""
+        span = self.start_span(name, kind, **attrs)
+        token = self._current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            self.end_span(span, "error", error=str(e)[:300])
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            self._current.reset(token)
+
+    def count(self, metric, value=1, **labels):
+        with self._lock:
+            self._counters[(metric, tuple(sorted(labels.items())))] += value
+
+    def trace(self, trace_id):
+        with self._lock:
+            return [dict(span) for span in self._traces.get(trace_id, [])]
+
+    def latest_trace_id(self, kind=None):
+        """Most recent trace, optionally only those whose root span is of `kind` (e.g. "run")."""
+        with self._lock:
+            for trace_id, spans in reversed(self._traces.items()):
+                if kind is None or (spans and spans[0]["kind"] == kind):
+                    return trace_id
+        return None
+
+    def span_counts(self, kind):
+        """{name: {status: count}} for one span kind, across the life of the process."""
+        with self._lock:
+            counts = {}
+            for (span_kind, name, status), n in self._span_counts.items():
+                if span_kind == kind:
+                    counts.setdefault(name, {})[status] = n
+            return counts
+
+    def to_jsonl(self, trace_id=None):
+        """One span per line: a single trace, or every trace still held in memory."""
+        with self._lock:
+            traces = [self._traces.get(trace_id, [])] if trace_id else list(self._traces.values())
+            return "".join(json.dumps(span, default=str) + "\n" for spans in traces for span in spans)
+
+    def prometheus_text(self):
+        """Prometheus text exposition format (0.0.4)."""
+        def labels(**items):
+            escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in items.items()}
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+        with self._lock:
+            lines = ["# HELP travel_planner_spans_total Finished spans by kind, name and status.",
+                     "# TYPE travel_planner_spans_total counter"]
+            lines += [f"travel_planner_spans_total{labels(kind=k, name=n, status=s)} {c}"
+                      for (k, n, s), c in sorted(self._span_counts.items())]
+            lines += ["# HELP travel_planner_span_seconds Time spent in spans by kind and name.",
+                      "# TYPE travel_planner_span_seconds summary"]
+            totals = collections.Counter()
+            for (k, n, _), c in self._span_counts.items():
+                totals[(k, n)] += c
+            for (k, n), seconds in sorted(self._span_seconds.items()):
+                lines.append(f"travel_planner_span_seconds_sum{labels(kind=k, name=n)} {seconds:.6f}")
+                lines.append(f"travel_planner_span_seconds_count{labels(kind=k, name=n)} {totals[(k, n)]}")
+            for metric in sorted({metric for metric, _ in self._counters}):
+                lines += [f"# TYPE travel_planner_{metric}_total counter"]
+                lines += [f"travel_planner_{metric}_total{labels(**dict(items))} {value}"
+                          for (name, items), value in sorted(self._counters.items()) if name == metric]
+            lines += ["# TYPE travel_planner_dropped_spans_total counter", f"travel_planner_dropped_spans_total {self.dropped_spans}"]
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(tracer, host, port):
+    """Tiny background HTTP server: /metrics (Prometheus text) and /traces.jsonl (recent spans)."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body, content_type = tracer.prometheus_text(), "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/traces.jsonl":
+                body, content_type = tracer.to_jsonl(), "application/x-ndjson"
+            else:
+                self.send_error(404)
+                return
+            payload = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+@process_resource()
+def get_tracer():
+    """One tracer per server process; starts the metrics endpoint the first time if a port is configured."""
+    tracer = Tracer(log_path=TRACE_LOG or None)
+    if METRICS_PORT:
+        try:
+            serve_metrics(tracer, METRICS_HOST, int(METRICS_PORT))
+        except OSError:
+            pass   # port already taken (e.g. a second server process); in-app tracing still works
+    return tracer
+
+
+def record_tool_calls(tools, tracer=None):
+    """Turns the tool calls agno timed during a run (SerpApi searches etc.) into child spans of the current span."""
+    tracer = tracer if tracer is not None else get_tracer()
+    for tool in tools or []:
+        metrics = getattr(tool, "metrics", None)
+        if metrics is None or not getattr(metrics, "start_time", None) or not getattr(metrics, "end_time", None):
+            continue
+        tracer.record_span(getattr(tool, "tool_name", None) or "tool", "tool", metrics.start_time, metrics.end_time,
+                           status="error" if getattr(tool, "tool_call_error", False) else "ok")
+
+
+# --- THE ULTIMATE WATERFALL IMAGE ENGINE ---
+# Provider endpoints; overridable so benchmarks can point the real engine at local stub servers
+UNSPLASH_API = os.environ.get("TRAVEL_PLANNER_UNSPLASH_API", "https://api.unsplash.com/search/photos")
+WIKI_API = os.environ.get("TRAVEL_PLANNER_WIKIPEDIA_API", "https://en.wikipedia.org/w/api.php")
+SERPAPI_API = os.environ.get("TRAVEL_PLANNER_SERPAPI_API", "https://serpapi.com/search.json")
+
+
+def _unsplash_image(query):
+    """TIER 1: Unsplash (Cinematic & Free)"""
+    if not API_KEYS["unsplash"]:
+        return None
+    data = get_http_pool().get_json("unsplash", UNSPLASH_API, params={
+        "query": query, "client_id": API_KEYS["unsplash"], "per_page": 1, "orientation": "landscape",
+    })
+    if data['results']:
+        return data['results'][0]['urls']['regular']
+    return None
+
+
+WIKI_BATCH_SIZE = 50   # MediaWiki's per-request limit on titles for anonymous clients
+
+
+def _is_photo(img_src):
+    """SMART FILTER: Reject if it is a map, flag, logo, or icon"""
+    lower_src = img_src.lower()
+    return not any(bad_word in lower_src for bad_word in ['map', 'flag', 'logo', '.svg', 'icon'])
+
+
+def _wiki_pageimages(titles):
+    """One batched prop=pageimages lookup (follows redirects).
+    Returns {title: thumbnail url, "" for an article without a usable photo, None if no such article}."""
+    data = get_http_pool().get_json("wikipedia", WIKI_API, params={
+        "action": "query", "titles": "|".join(titles), "redirects": 1, "prop": "pageimages|pageprops",
+        "ppprop": "disambiguation", "piprop": "thumbnail", "pithumbsize": 1000, "pilimit": WIKI_BATCH_SIZE,
+        "format": "json",
+    })
+    query = data.get('query', {})
+    aliases = {step['from']: step['to'] for step in query.get('normalized', []) + query.get('redirects', [])}
+    pages = {page.get('title'): page for page in query.get('pages', {}).values()}
+
+    found = {}
+    for title in titles:
+        resolved = title
+        for _ in range(3):  # requested -> normalized -> redirect target
+            if resolved in pages:
+                break
+            resolved = aliases.get(resolved, resolved)
+        page = pages.get(resolved)
+        if page is None or 'missing' in page or 'invalid' in page or 'disambiguation' in page.get('pageprops', {}):
+            found[title] = None
+        else:
+            img_src = page.get('thumbnail', {}).get('source', "")
+            found[title] = img_src if img_src and _is_photo(img_src) else ""
+    return found
+
+
+def _wiki_search(title):
+    """Top full-text search hit for a title, or None."""
+    data = get_http_pool().get_json("wikipedia", WIKI_API, params={
+        "action": "query", "list": "search", "srsearch": title, "srlimit": 1, "utf8": "", "format": "json",
+    })
+    results = data['query']['search']
+    return results[0]['title'] if results else None
+
+
+class WikipediaBatch:
+    """TIER 2: Smart Wikipedia Filter (Rejects maps and logos), resolved for a whole dossier at once.
+
+    On the first request it looks every query up by exact title in batched pageimages calls, runs
+    full-text searches concurrently only for queries with no matching article, then fetches all of
+    the searched articles' thumbnails in one more batched call. ~20 locations cost a handful of
+    requests instead of ~40. Stages chain through future callbacks, so no pool thread ever blocks
+    waiting on another. submit(query) returns a Future of the image URL (or None).
+    """
+
+    def __init__(self, queries):
+        self._futures = {query: concurrent.futures.Future() for query in queries}
+        self._lock = threading.Lock()
+        self._started = False
+        self._outstanding = 0
+        self._to_search = []       # queries with no exact-title article
+        self._search_hits = {}     # query -> article title found by search
+
+    def submit(self, query):
+        if query not in self._futures:
+            return WikipediaBatch([query]).submit(query)
+        with self._lock:
+            future = self._futures[query]
+            start, self._started = not self._started, True
+        if start:
+            self._lookup_titles()
+        return future
+
+    def _settle(self, queries, result=None, error=None):
+        for query in queries:
+            try:
+                if error is not None:
+                    self._futures[query].set_exception(error)
+                else:
+                    self._futures[query].set_result(result)
+            except concurrent.futures.InvalidStateError:
+                pass  # the race already cancelled or settled it
+
+    @staticmethod
+    def _group_by_title(queries, title_of):
+        groups = collections.defaultdict(list)
+        for query in queries:
+            groups[title_of(query)].append(query)
+        return groups
+
+    def _run_stage(self, jobs, on_done, on_empty):
+        """Submits (fn, arg, context) jobs; calls on_done(context, future) per job and on_empty() after the last."""
+        if not jobs:
+            on_empty()
+            return
+        with self._lock:
+            self._outstanding = len(jobs)
+        http = get_http_pool()
+
+        def callback(context, future):
+            try:
+                on_done(context, future)
+            finally:
+                with self._lock:
+                    self._outstanding -= 1
+                    last = self._outstanding == 0
+                if last:
+                    on_empty()
+
+        for fn, arg, context in jobs:
+            http.submit(fn, arg, provider="wikipedia").add_done_callback(functools.partial(callback, context))
+
+    # Stage 1: exact-title lookups, WIKI_BATCH_SIZE titles per request
+    def _lookup_titles(self):
+        groups = self._group_by_title(list(self._futures), lambda q: q.split(',')[0].strip()) # Removes city name to prevent wiki confusion
+        lookups = [title for title in groups if title and '|' not in title]
+        self._to_search = [q for title, qs in groups.items() if title not in lookups for q in qs]
+        chunks = [lookups[i:i + WIKI_BATCH_SIZE] for i in range(0, len(lookups), WIKI_BATCH_SIZE)]
+
+        def on_done(chunk, future):
+            try:
+                found = future.result()
+            except Exception:
+                found = {}
+            for title in chunk:
+                if found.get(title) is None:
+                    with self._lock:
+                        self._to_search.extend(groups[title])
+                else:
+                    self._settle(groups[title], found[title] or None)
+
+        self._run_stage([(_wiki_pageimages, chunk, chunk) for chunk in chunks], on_done, self._search_missing)
+
+    # Stage 2: concurrent full-text searches for whatever had no exact article
+    def _search_missing(self):
+        groups = self._group_by_title(self._to_search, lambda q: q.split(',')[0].strip())
+
+        def on_done(title, future):
+            try:
+                hit = future.result()
+            except Exception as e:
+                self._settle(groups[title], error=e)
+                return
+            if hit is None:
+                self._settle(groups[title], None)
+            else:
+                with self._lock:
+                    for query in groups[title]:
+                        self._search_hits[query] = hit
+
+        self._run_stage([(_wiki_search, title, title) for title in groups if title], on_done, self._fetch_search_thumbnails)
+        if '' in groups:
+            self._settle(groups[''], None)
+
+    # Stage 3: one batched thumbnail call for every searched article
+    def _fetch_search_thumbnails(self):
+        groups = self._group_by_title(list(self._search_hits), self._search_hits.get)
+        titles = list(groups)
+        chunks = [titles[i:i + WIKI_BATCH_SIZE] for i in range(0, len(titles), WIKI_BATCH_SIZE)]
+
+        def on_done(chunk, future):
+            try:
+                found = future.result()
+            except Exception as e:
+                for title in chunk:
+                    self._settle(groups[title], error=e)
+                return
+            for title in chunk:
+                self._settle(groups[title], found.get(title) or None)
+
+        self._run_stage([(_wiki_pageimages, chunk, chunk) for chunk in chunks], on_done, lambda: None)
+
+
+def _serpapi_image(query):
+    """TIER 3: SerpApi Google Images (Pinpoint Accuracy for Restaurants/Specifics)"""
+    if not API_KEYS["serpapi"]:
+        return None
+    # The quota token (shared with the agents' web searches) was taken before this job reached the pool
+    scheduler = get_quota_scheduler()
+    try:
+        data = get_http_pool().get_json("serpapi", SERPAPI_API, params={
+            "engine": "google_images", "q": query, "api_key": API_KEYS["serpapi"],
+        })
+    except requests.HTTPError as e:
+        if is_rate_limit_error(e):
+            retry_after = e.response.headers.get("Retry-After", "") if e.response is not None else ""
+            scheduler.backoff("serpapi", e, float(retry_after) if retry_after.isdigit() else None)
+        raise
+    scheduler.succeeded("serpapi")
+    if 'images_results' in data and len(data['images_results']) > 0:
+        return data['images_results'][0]['original']
+    return None
+
+
+def _pollinations_image(query):
+    """TIER 4: Pollinations AI (Failsafe Placeholder)"""
+    return f"https://image.pollinations.ai/prompt/Realistic+Cinematic+Photography+of+{urllib.parse.quote(query)}?width=1000&height=500"
+
+
+def _per_query(fn, provider, **queueing):
+    """Adapts a single-query tier function to the batch interface: queries -> (query -> Future)."""
+    return lambda queries: (lambda query: get_http_pool().submit(fn, query, provider=provider, **queueing))
+
+
+# Hedged mode: start the next tier speculatively if the current one is slow, but still honour tier priority
+IMAGE_HEDGING = os.environ.get("TRAVEL_PLANNER_IMAGE_HEDGING", "1") != "0"
+IMAGE_HEDGE_DELAY = 0.6   # seconds to wait on a tier before also starting the next one
+IMAGE_DEADLINE = 4.0      # overall budget per image before the Pollinations failsafe
+
+# Each tier is built once per batch of queries and hands back a launcher: query -> Future of url-or-None
+IMAGE_TIERS = [
+    ("unsplash", _per_query(_unsplash_image, "unsplash")),
+    ("wikipedia", lambda queries: WikipediaBatch(queries).submit),
+    # A quota queue longer than the image budget fails the tier, so that miss is not cached
+    ("serpapi", _per_query(_serpapi_image, "serpapi", quota="serpapi", max_wait=IMAGE_DEADLINE)),
+]
+
+
+class _TierRace:
+    """One query's waterfall as a non-blocking state machine; tier requests run on the shared HTTP pool.
+
+    A lower tier starts after hedge_delay (or as soon as every tier above it has given up), and the
+    highest-priority hit wins once all tiers above it have answered. With hedge_delay and deadline set
+    to infinity this is exactly the classic sequential waterfall.
+    """
+
+    def __init__(self, query, launchers, hedge_delay, deadline, tracer=None):
+        self.query = query
+        self.launchers = launchers
+        self.hedge_delay = hedge_delay
+        self.tracer = tracer if tracer is not None else get_tracer()
+        self.spans = {}     # tier index -> span, opened under whatever span is current (resolve_images' "images")
+        self.started = time.monotonic()
+        self.deadline_at = self.started + deadline
+        self.futures = {}   # tier index -> Future
+        self.results = {}   # tier index -> url or None
+        self.had_errors = False
+        self.finished = False
+        self.outcome = (None, None, False)   # (url, tier, had_errors)
+        self._last_launch = self.started
+        self._launch()
+
+    def _launch(self):
+        idx = len(self.futures)
+        self.spans[idx] = self.tracer.start_span(IMAGE_TIERS[idx][0], "image_tier", query=self.query)
+        self.futures[idx] = self.launchers[idx](self.query)
+        self._last_launch = time.monotonic()
+
+    def _finish(self, url, tier, had_errors, timed_out=False):
+        self.finished = True
+        self.outcome = (url, tier, had_errors)
+        for idx, f in self.futures.items():
+            f.cancel()
+            if idx not in self.results:
+                # Still in flight: either the budget ran out or a higher-priority tier already won
+                self.tracer.end_span(self.spans[idx], "timeout" if timed_out else "cancelled")
+
+    def pending(self):
+        return [f for idx, f in self.futures.items() if idx not in self.results]
+
+    def advance(self):
+        """Collects finished tiers, settles the race if possible, launches hedges. Returns the next wake-up time."""
+        while not self.finished:
+            for idx, f in self.futures.items():
+                if idx not in self.results and f.done():
+                    try:
+                        self.results[idx] = f.result()
+                    except Exception as e:
+                        self.results[idx] = None
+                        self.had_errors = True
+                        self.tracer.end_span(self.spans[idx], "error", error=str(e)[:300])
+                    else:
+                        self.tracer.end_span(self.spans[idx], "hit" if self.results[idx] else "miss")
+
+            for idx in range(len(IMAGE_TIERS)):
+                if idx not in self.results:
+                    break
+                if self.results[idx]:
+                    self._finish(self.results[idx], IMAGE_TIERS[idx][0], self.had_errors)
+                    return None
+            else:
+                self._finish(None, None, self.had_errors)
+                return None
+
+            now = time.monotonic()
+            if now >= self.deadline_at:
+                # Budget exhausted: take the best answer we already have rather than waiting on a better tier
+                best = next((idx for idx in sorted(self.results) if self.results[idx]), None)
+                if best is None:
+                    self._finish(None, None, True, timed_out=True)
+                else:
+                    self._finish(self.results[best], IMAGE_TIERS[best][0], True, timed_out=True)
+                return None
+
+            hit_above = any(self.results.get(idx) for idx in range(len(self.futures)))
+            can_launch = len(self.futures) < len(IMAGE_TIERS) and not hit_above
+            if can_launch and (not self.pending() or now - self._last_launch >= self.hedge_delay):
+                self._launch()
+                continue
+            wake_at = self.deadline_at
+            if can_launch:
+                wake_at = min(wake_at, self._last_launch + self.hedge_delay)
+            return wake_at
+        return None
+
+
+def _run_waterfalls(queries):
+    """Drives every query's race from the calling thread. Returns {query: (url, tier, had_errors)}."""
+    if IMAGE_HEDGING:
+        hedge_delay, deadline = IMAGE_HEDGE_DELAY, IMAGE_DEADLINE
+    else:
+        hedge_delay, deadline = float("inf"), float("inf")
+    launchers = [make_launcher(queries) for _, make_launcher in IMAGE_TIERS]
+    tracer = get_tracer()
+    races = [_TierRace(query, launchers, hedge_delay, deadline, tracer) for query in queries]
+
+    while True:
+        pending, wake_at = [], float("inf")
+        for race in races:
+            race_wake = race.advance()
+            if not race.finished:
+                pending.extend(race.pending())
+                if race_wake is not None:
+                    wake_at = min(wake_at, race_wake)
+        if not pending and all(race.finished for race in races):
+            break
+        timeout = None if wake_at == float("inf") else max(0.0, wake_at - time.monotonic())
+        concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    return {race.query: race.outcome for race in races}
+
+
+def resolve_images(queries, cache=None):
+    """Resolves many queries at once: cache first, then one concurrent waterfall per miss. Returns {query: url}.
+
+    A miss that another session is already resolving is not raced again: this call waits for that waterfall.
+    """
+    cache = cache if cache is not None else get_image_cache()
+    tracer = get_tracer()
+    flights = get_image_flights()
+    resolved = {}
+    to_fetch = {}   # query -> normalized key
+    with tracer.span("images", "images", queries=len(queries)) as span:
+        for query in queries:
+            cached_url = cache.get(query)
+            if cached_url:
+                resolved[query] = cached_url
+            else:
+                to_fetch[query] = normalize_image_query(query)
+        span["attrs"]["cache_hits"] = len(resolved)
+        tracer.count("image_resolutions", len(resolved), source="cache")
+
+        owned, joined = flights.claim(to_fetch.values())
+        leaders = {}    # one query per key this call resolves
+        for query, key in to_fetch.items():
+            if key in owned:
+                leaders.setdefault(key, query)
+        urls = {}
+        try:
+            for query, (img_url, tier, had_errors) in _run_waterfalls(list(leaders.values())).items():
+                tracer.count("image_resolutions", source=tier or "failsafe")
+                if img_url:
+                    cache.put(query, img_url, tier)
+                    urls[to_fetch[query]] = img_url
+                    continue
+                urls[to_fetch[query]] = _pollinations_image(query)
+                # Only a clean "nobody has this" is negative-cached; timeouts and outages get retried next time
+                if not had_errors:
+                    cache.put(query, urls[to_fetch[query]], "miss")
+        finally:
+            # Always settle, so sessions waiting on these queries never hang on an abandoned waterfall
+            for key in owned:
+                flights.settle(key, urls.get(key))
+
+        span["attrs"]["coalesced"] = len(joined)
+        tracer.count("image_resolutions", len(joined), source="coalesced")
+        for query, key in to_fetch.items():
+            url = urls[key] if key in urls else (joined[key].result() if key in joined else None)
+            resolved[query] = url or _pollinations_image(query)
+    return resolved
+
+
+def fetch_real_image(query, cache=None):
+    """4-Tier Image Fetcher: Cache -> Unsplash -> Smart Wikipedia -> SerpApi (Google Images) -> AI Failsafe"""
+    return resolve_images([query], cache)[query]
+
+
+# --- DOSSIER-WIDE PLACEHOLDER RESOLUTION ---
+PLACEHOLDER_PATTERN = re.compile(r"\[REAL_IMG:\s*(.*?)\s*\]")
+
+
+class PlaceholderResolver:
+    """One [REAL_IMG] resolution stage shared by every section of a dossier.
+
+    Each section is scanned once; queries are deduplicated by their normalized form across the whole
+    dossier, so a place named in the itinerary and again in the hotels is resolved a single time even
+    when the sections arrive concurrently. Rewriting is one regex-callback pass per section, which
+    also catches whitespace variants like `[REAL_IMG:  X ]` that a literal replace would miss.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else get_image_cache()
+        self._lock = threading.Lock()
+        self._urls = {}       # normalized query -> url
+        self._pending = {}    # normalized query -> threading.Event, while another section resolves it
+        self.placeholders = 0
+        self.unresolved = 0
+
+    def resolve_section(self, text):
+        keys = {}
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            key = normalize_image_query(match.group(1))
+            if key:
+                keys.setdefault(key, match.group(1))
+
+        with self._lock:
+            mine = {key: query for key, query in keys.items() if key not in self._urls and key not in self._pending}
+            theirs = [self._pending[key] for key in keys if key in self._pending]
+            for key in mine:
+                self._pending[key] = threading.Event()
+
+        if mine:
+            try:
+                urls = resolve_images(list(mine.values()), self.cache)
+                with self._lock:
+                    for key, query in mine.items():
+                        self._urls[key] = urls.get(query)
+            finally:
+                with self._lock:
+                    for key in mine:
+                        self._pending.pop(key).set()
+        for event in theirs:
+            event.wait()
+
+        counts = {"placeholders": 0, "unresolved": 0}
+
+        def substitute(match):
+            counts["placeholders"] += 1
+            url = self._urls.get(normalize_image_query(match.group(1)))
+            if not url:
+                counts["unresolved"] += 1
+                return match.group(0)
+            return url
+
+        text = PLACEHOLDER_PATTERN.sub(substitute, text)
+        with self._lock:
+            self.placeholders += counts["placeholders"]
+            self.unresolved += counts["unresolved"]
+        return text
+
+    def stats(self):
+        with self._lock:
+            return {"placeholders": self.placeholders, "unique_queries": len(self._urls), "unresolved": self.unresolved}
+
+    def flush(self):
+        """Persists the image cache; called once when the whole run is over, not after every section."""
+        self.cache.flush()
+
+
+def process_images(text, cache=None):
+    """Finds all [REAL_IMG] placeholders and concurrently runs the Waterfall Engine."""
+    placeholders = PlaceholderResolver(cache)
+    try:
+        return placeholders.resolve_section(text)
+    finally:
+        placeholders.flush()
+
+# --- LOCAL IMAGE PROXY ---
+IMAGE_PROXY_PORT = os.environ.get("TRAVEL_PLANNER_IMAGE_PROXY_PORT", "")     # serve downscaled copies of dossier images on this port
+IMAGE_PROXY_HOST = os.environ.get("TRAVEL_PLANNER_IMAGE_PROXY_HOST", "127.0.0.1")
+IMAGE_PROXY_URL = os.environ.get("TRAVEL_PLANNER_IMAGE_PROXY_URL", "")       # how browsers reach it, when not at host:port directly
+IMAGE_MAX_WIDTH = 1200            # the widest an image is ever displayed (full-width banner)
+IMAGE_QUALITY = 80
+IMAGE_MAX_SOURCE_BYTES = 20 * 1024 * 1024
+IMAGE_BYTES_MAX = 256 * 1024 * 1024
+IMG_SRC_PATTERN = re.compile(r'(<img\s[^>]*?src=")(https?://[^"]+)(")')
+# Image URLs come from model output shaped by web results, so the server only fetches public hosts
+IMAGE_ALLOW_PRIVATE = os.environ.get("TRAVEL_PLANNER_IMAGE_ALLOW_PRIVATE", "0") == "1"   # local stub servers only
+
+
+def is_public_url(url):
+    """True if url is http(s) and its host resolves only to global addresses (no loopback, LAN, link-local...)."""
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if IMAGE_ALLOW_PRIVATE:
+        return True
+    try:
+        infos = socket.getaddrinfo(parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80), proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError):
+        return False
+    return bool(infos) and all(ipaddress.ip_address(info[4][0].split("%")[0]).is_global for info in infos)
+
+
+def downscale_image(data, max_width=IMAGE_MAX_WIDTH, quality=IMAGE_QUALITY):
+    """Re-encodes an image as WebP no wider than max_width. Returns None without Pillow or for undecodable input."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")   # first frame of animations
+            if img.width > max_width:
+                img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, "WEBP", quality=quality, method=4)
+    except Exception:
+        return None
+    return out.getvalue()
+
+
+class ByteCache:
+    """Opaque files on disk, one per key, bounded by total size (least recently used goes first).
+
+    Like the dossier cache, the index lives in memory and is rebuilt from the directory (oldest file first) on start.
+    """
+
+    def __init__(self, directory, max_bytes, suffix):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._index = collections.OrderedDict()   # key -> size
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        try:
+            names = [(os.path.getmtime(os.path.join(directory, n)), n) for n in os.listdir(directory) if n.endswith(suffix)]
+        except OSError:
+            names = []
+        for _, name in sorted(names):
+            size = os.path.getsize(os.path.join(directory, name))
+            self._index[name[:-len(suffix)]] = size
+            self._bytes += size
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def _evict(self):
+        while self._index and self._bytes > self.max_bytes:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def open(self, key):
+        """The stored file opened for binary reading, or None on a miss."""
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+        try:
+            return open(self._path(key), "rb")   # stays readable even if evicted meanwhile
+        except OSError:
+            with self._lock:
+                self._bytes -= self._index.pop(key, 0)
+            return None
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def temp_file(self):
+        """(file, path) of a new temporary file in the cache directory, to be written and then adopted."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        return os.fdopen(fd, "wb"), tmp_path
+
+    def adopt(self, key, tmp_path):
+        """Moves a finished temporary file into the cache under key."""
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self._evict()
+
+    def put(self, key, data):
+        try:
+            f, tmp_path = self.temp_file()
+            with f:
+                f.write(data)
+            self.adopt(key, tmp_path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._index), "bytes": self._bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class ImageBytes:
+    """Remote images fetched once, downscaled to display size and kept in a byte cache, for the proxy and exports."""
+
+    def __init__(self, cache, workers=PROVIDER_CONCURRENCY["images"]):
+        self.cache = cache
+        self._flights = InFlight()
+        # Own small pool: bulk downloads must never take the shared HTTP workers the image tier races wait on
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-bytes")
+
+    def prefetch(self, src):
+        """Fetches src into the cache in the background; the Future tells whether it made it (not the bytes)."""
+        return self.executor.submit(contextvars.copy_context().run, lambda: self.image(src) is not None)
+
+    def image(self, src):
+        """Downscaled WebP bytes for a source URL, fetched at most once at a time; None if it cannot be had."""
+        key = hashlib.sha256(src.encode("utf-8")).hexdigest()
+        data = self.cache.get(key)
+        if data is not None:
+            get_tracer().count("image_bytes", result="hit")
+            return data
+        owned, joined = self._flights.claim([key])
+        if joined:
+            return joined[key].result()
+        data = None
+        try:
+            body, _ = get_http_pool().get_bytes("images", src, max_bytes=IMAGE_MAX_SOURCE_BYTES, allow_url=is_public_url)
+            data = downscale_image(body)
+            if data is not None:
+                self.cache.put(key, data)
+        except Exception:
+            pass
+        finally:
+            self._flights.settle(key, data)
+        get_tracer().count("image_bytes", result="fetched" if data is not None else "failed")
+        return data
+
+
+@process_resource()
+def get_image_bytes():
+    return ImageBytes(ByteCache(os.path.join(CACHE_DIR, "image_bytes"), IMAGE_BYTES_MAX, ".webp"))
+
+
+class ImageProxy:
+    """Local URLs for remote images, served from ImageBytes.
+
+    A proxied URL carries its source URL and an HMAC of it, so the proxy only ever fetches what this app put into a
+    page (it is not an open proxy) and its URLs stay valid across restarts. Anything it cannot fetch or decode is
+    answered with a redirect to the original.
+    """
+
+    def __init__(self, images, base_url, secret):
+        self.images = images
+        self.base_url = base_url.rstrip("/")
+        self.secret = secret
+
+    def _sign(self, src):
+        return hmac.new(self.secret, src.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+    def url_for(self, src):
+        encoded = base64.urlsafe_b64encode(src.encode("utf-8")).decode("ascii").rstrip("=")
+        return f"{self.base_url}/img/{self._sign(src)}/{encoded}"
+
+    def source_for(self, signature, encoded):
+        """The original URL behind a proxied path, or None if the signature does not match."""
+        try:
+            src = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode("utf-8")
+        except ValueError:
+            return None
+        return src if hmac.compare_digest(signature, self._sign(src)) else None
+
+    def rewrite(self, text):
+        """Points every <img src="http..."> in a Markdown/HTML fragment at the proxy."""
+        return IMG_SRC_PATTERN.sub(lambda m: m.group(1) + self.url_for(m.group(2)) + m.group(3), text)
+
+    def warm(self, text):
+        """Fetches a fragment's images in the background, so the first view is already served locally."""
+        for src in dict.fromkeys(m.group(2) for m in IMG_SRC_PATTERN.finditer(text)):
+            self.images.prefetch(src)
+
+
+def serve_images(proxy, host, port):
+    """Background HTTP server for /img/<signature>/<source>: cached WebP bytes, or a redirect to the source."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.split("?", 1)[0].split("/")
+            src = proxy.source_for(parts[2], parts[3]) if len(parts) == 4 and parts[1] == "img" else None
+            if src is None:
+                self.send_error(404)
+                return
+            data = proxy.images.image(src)
+            if data is None:
+                self.send_response(302)
+                self.send_header("Location", src)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/webp")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")   # a URL's bytes never change
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="image-proxy", daemon=True).start()
+    return server
+
+
+def _proxy_secret(path):
+    """Per-install signing key, created on first use and shared by every process using this cache directory."""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        pass
+    secret = os.urandom(32)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+    except FileExistsError:
+        with open(path, "rb") as f:   # another process won the race
+            return f.read()
+    except OSError:
+        pass
+    return secret
+
+
+@process_resource()
+def get_image_proxy():
+    """The process's image proxy, or None when no proxy port is configured. Starts its server the first time."""
+    if not IMAGE_PROXY_PORT:
+        return None
+    proxy = ImageProxy(get_image_bytes(),
+                       IMAGE_PROXY_URL or f"http://{IMAGE_PROXY_HOST}:{IMAGE_PROXY_PORT}",
+                       _proxy_secret(os.path.join(CACHE_DIR, "image_proxy.key")))
+    try:
+        serve_images(proxy, IMAGE_PROXY_HOST, int(IMAGE_PROXY_PORT))
+    except OSError:
+        pass   # port taken by another server process on this cache directory; it serves the same signed URLs
+    return proxy
+
+
+def proxy_images(text):
+    """A dossier fragment with its images pointed at the local proxy (unchanged when the proxy is off)."""
+    proxy = get_image_proxy()
+    return proxy.rewrite(text) if proxy else text
+
+
+def proxy_image_url(url):
+    proxy = get_image_proxy()
+    return proxy.url_for(url) if proxy and url.startswith(("http://", "https://")) else url
+
+
+# --- EVENT-DRIVEN GENERATION PIPELINE ---
+class TaskGraph:
+    """Tiny dependency graph: each task runs as soon as the tasks it depends on finish.
+
+    Tasks receive their dependencies' results as positional arguments. Completions, notes and the
+    first failure are pushed onto an event queue, so the caller waits on signals instead of polling.
+    With a tracer, each task runs inside a "phase" span under the span that was current at start().
+    """
+
+    def __init__(self, tracer=None):
+        self._tasks = {}       # name -> (fn, deps)
+        self._results = {}
+        self._submitted = set()
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._context = None
+        self._tracer = tracer
+        self.failed = False
+
+    def add(self, name, fn, deps=()):
+        self._tasks[name] = (fn, tuple(deps))
+
+    def start(self, executor):
+        self._executor = executor
+        self._context = contextvars.copy_context()   # tasks run in worker threads but keep the caller's span
+        self._schedule()
+
+    def _schedule(self):
+        with self._lock:
+            if self.failed:
+                return
+            ready = [name for name, (_, deps) in self._tasks.items()
+                     if name not in self._submitted and all(dep in self._results for dep in deps)]
+            self._submitted.update(ready)
+        for name in ready:
+            fn, deps = self._tasks[name]
+            try:
+                future = self._executor.submit(self._context.copy().run, self._run_task, name, fn, [self._results[dep] for dep in deps])
+            except RuntimeError as e:  # executor already shut down after a failure elsewhere
+                self._on_failure(name, e)
+                return
+            future.add_done_callback(functools.partial(self._on_done, name))
+
+    def _run_task(self, name, fn, args):
+        if self._tracer is None:
+            return fn(*args)
+        with self._tracer.span(name, "phase"):
+            return fn(*args)
+
+    def _on_failure(self, name, error):
+        with self._lock:
+            first, self.failed = not self.failed, True
+        if first:
+            self._events.put(("failed", name, error))
+
+    def _on_done(self, name, future):
+        try:
+            result = future.result()
+        except BaseException as e:
+            self._on_failure(name, e)
+            return
+        with self._lock:
+            self._results[name] = result
+        self._events.put(("done", name, None))
+        self._schedule()
+
+    def post(self, kind, name, payload):
+        """Lets a running task hand any event (partial results, progress) to the caller's thread."""
+        self._events.put((kind, name, payload))
+
+    def note(self, name, text):
+        """Lets a running task surface a progress message on the caller's thread."""
+        self.post("note", name, text)
+
+    def next_event(self, timeout=None):
+        """Waits for the next (kind, task name, payload) event: "done", "failed", "note" or anything a task
+        posted. Returns None if the timeout passes first."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    @property
+    def finished(self):
+        with self._lock:
+            return len(self._results) == len(self._tasks)
+
+    def result(self, name):
+        return self._results[name]
+
+
+# --- STREAMING ITINERARY ---
+STREAM_ITINERARY = os.environ.get("TRAVEL_PLANNER_STREAM_ITINERARY", "1") != "0"
+DAY_HEADER_PATTERN = re.compile(r"^## Day \d+:.*$", re.MULTILINE)
+
+
+class DayStreamSplitter:
+    """Cuts a streamed itinerary into days as it arrives: a day is closed once the next `## Day N:` header
+    line is complete (or the stream ends). Yields (header, segment) pairs where the segment still contains
+    its header line, so joining every segment reproduces the full text; header is None for the intro."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_days = False
+
+    def feed(self, delta):
+        self._buffer += delta
+        return self._drain(final=False)
+
+    def close(self):
+        return self._drain(final=True)
+
+    def _drain(self, final):
+        closed = []
+        while True:
+            # A header at the very end of the buffer may still be growing, so it only counts once its line ends
+            headers = [m for m in DAY_HEADER_PATTERN.finditer(self._buffer) if final or m.end() < len(self._buffer)]
+            if not self._in_days:
+                if not headers:
+                    break
+                if self._buffer[:headers[0].start()].strip():
+                    closed.append((None, self._buffer[:headers[0].start()]))
+                self._buffer = self._buffer[headers[0].start():]
+                self._in_days = True
+            elif len(headers) >= 2:
+                closed.append((headers[0].group(0).strip(), self._buffer[:headers[1].start()]))
+                self._buffer = self._buffer[headers[1].start():]
+            else:
+                break
+        if final and self._buffer.strip():
+            header = DAY_HEADER_PATTERN.match(self._buffer) if self._in_days else None
+            closed.append((header.group(0).strip() if header else None, self._buffer))
+            self._buffer = ""
+        return closed
+
+
+def stream_agent_text(agent, prompt):
+    """Runs an agent with stream=True and yields its content deltas; surfaces in-stream errors as exceptions."""
+    for event in agent.run(prompt, stream=True):
+        kind = getattr(event, "event", None)
+        if kind == "RunError":
+            raise RuntimeError(getattr(event, "content", None) or "streaming run failed")
+        if kind == "ToolCallCompleted":
+            record_tool_calls([getattr(event, "tool", None)])
+        if kind == "RunContent" and isinstance(getattr(event, "content", None), str):
+            yield event.content
+
+
+# --- PER-AGENT MODEL FALLBACK & CIRCUIT BREAKER ---
+FALLBACK_MODELS = ["gemini-3-flash-preview", "gemini-3.1-flash-lite-preview", "gemini-2.5-flash"]
+BREAKER_FAILURE_THRESHOLD = 2     # consecutive ordinary errors before a model is skipped
+BREAKER_COOLDOWN = 30             # seconds an erroring model is skipped (doubles on each re-trip)
+BREAKER_RATE_LIMIT_COOLDOWN = 90  # seconds a rate-limited model is skipped (trips immediately)
+BREAKER_MAX_COOLDOWN = 900
+BREAKER_TRIAL_WINDOW = 120        # seconds everyone else keeps skipping a model while its half-open trial call runs
+
+
+def is_rate_limit_error(error):
+    """True for 429 / quota / resource-exhausted failures from any of the SDKs we call."""
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in ["429", "quota", "resource_exhausted", "resource exhausted", "rate limit"])
+
+
+class ModelCircuitBreaker:
+    """Remembers failing models across sessions so new requests skip them instead of re-paying the failure.
+
+    Rate limits trip a model immediately; other errors after BREAKER_FAILURE_THRESHOLD in a row.
+    When the cooldown ends one trial call is let through (half-open) and the model stays skipped for everyone
+    else until it reports: success closes the circuit, another failure re-opens it with a doubled cooldown.
+    A trial that never reports (cancelled, or queued out by the scheduler) frees the model after BREAKER_TRIAL_WINDOW.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}   # model_id -> {"failures", "trips", "open_until", "reason"}
+
+    def _entry(self, model_id):
+        return self._state.setdefault(model_id, {"failures": 0, "trips": 0, "open_until": 0.0, "reason": ""})
+
+    def candidates(self, models):
+        """Models worth trying, in fallback order. If every one is cooling down, the one that recovers first."""
+        now = time.time()
+        with self._lock:
+            available = [m for m in models if self._entry(m)["open_until"] <= now]
+            if available or not models:
+                return available
+            return [min(models, key=lambda m: self._entry(m)["open_until"])]
+
+    def allow(self, model_id, models):
+        """Whether this caller may try model_id now; a recovering model is handed to one caller, as its trial."""
+        now = time.time()
+        with self._lock:
+            entry = self._entry(model_id)
+            if entry["open_until"] <= now:
+                if entry["trips"]:
+                    entry["open_until"] = now + BREAKER_TRIAL_WINDOW
+                    entry["reason"] = "half-open trial"
+                return True
+            if any(self._entry(m)["open_until"] <= now for m in models):
+                return False
+            # Every model is cooling down: the one that recovers first is tried anyway rather than failing outright
+            return model_id == min(models, key=lambda m: self._entry(m)["open_until"])
+
+    def record_success(self, model_id):
+        with self._lock:
+            self._state[model_id] = {"failures": 0, "trips": 0, "open_until": 0.0, "reason": ""}
+
+    def record_failure(self, model_id, error):
+        rate_limited = is_rate_limit_error(error)
+        with self._lock:
+            entry = self._entry(model_id)
+            entry["failures"] += 1
+            # A failure during the half-open trial (trips > 0) re-opens straight away
+            if rate_limited or entry["trips"] or entry["failures"] >= BREAKER_FAILURE_THRESHOLD:
+                base = BREAKER_RATE_LIMIT_COOLDOWN if rate_limited else BREAKER_COOLDOWN
+                entry["open_until"] = time.time() + min(base * (2 ** entry["trips"]), BREAKER_MAX_COOLDOWN)
+                entry["trips"] += 1
+                entry["reason"] = "rate limited" if rate_limited else "erroring"
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {m: {"open": e["open_until"] > now, "retry_in": max(0, int(e["open_until"] - now)), "reason": e["reason"]}
+                    for m, e in self._state.items()}
+
+
+@process_resource()
+def get_model_breaker():
+    """One breaker per server process, shared by every session."""
+    return ModelCircuitBreaker()
+
+
+# --- QUOTA-AWARE SCHEDULER ---
+PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch", PRIORITY_BACKGROUND: "background"}
+QUOTA_BURST = 4                 # calls a bucket may start back to back (one generation launches four agents)
+QUOTA_BACKOFF = 2.0             # first pause after a 429 when the provider names no retry delay; doubles per repeat
+QUOTA_MAX_BACKOFF = 120.0
+QUOTA_MAX_WAIT = 90.0           # longest a model call queues before moving on to the next engine
+QUOTA_TOOL_MAX_WAIT = 10.0      # longest an agent's web search queues before it is told to do without
+QUOTA_RETRIES = 3               # queued retries once every model of a fallback chain is rate limited
+RETRY_DELAY_PATTERN = re.compile(r"retry(?:[ _-]?delay)?\W*(?:in|after)?\W*(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+_request_priority = contextvars.ContextVar("travel_planner_priority", default=PRIORITY_INTERACTIVE)
+
+
+def parse_quotas(spec):
+    """"gemini=60,gemini:gemini-2.5-flash=10,serpapi=100" -> {bucket: calls per minute}."""
+    quotas = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        bucket, _, rate = part.rpartition("=")
+        quotas[bucket.strip()] = float(rate)
+    return quotas
+
+
+QUOTAS = parse_quotas(os.environ.get("TRAVEL_PLANNER_QUOTAS", ""))   # unlisted buckets only get backoff and ordering
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Every scheduled call made in this context (and in the tasks it starts) queues at this priority."""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class QuotaWaitTimeout(TimeoutError):
+    pass
+
+
+class CancelledRun(Exception):
+    """Raised by a run that was abandoned before its model call; never counted against the model."""
+
+
+class QuotaScheduler:
+    """Token buckets per provider ("gemini", "serpapi") and per model ("gemini:<model>"), shared by every caller.
+
+    Callers queue on a bucket in priority order (interactive, then batch, then background; first come first
+    served within one), so a batch run never starves a visitor. A 429 reported through backoff() pauses that
+    bucket for the provider's retry delay or an exponential backoff, and the next success resets it. Buckets
+    without a configured rate never run out of tokens; they only apply backoff and ordering.
+    """
+
+    def __init__(self, quotas=None):
+        self.quotas = dict(QUOTAS if quotas is None else quotas)
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._tickets = itertools.count()
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.quotas.get(key, 0) / 60.0
+            bucket = self._buckets[key] = {"rate": rate, "tokens": float(QUOTA_BURST), "updated": time.monotonic(),
+                                           "paused_until": 0.0, "backoff": QUOTA_BACKOFF, "waiters": []}
+        return bucket
+
+    def set_quota(self, key, per_minute):
+        """Sets (or with 0/None removes) a bucket's rate at runtime."""
+        with self._cond:
+            self.quotas[key] = per_minute or 0
+            self._bucket(key)["rate"] = (per_minute or 0) / 60.0
+            self._cond.notify_all()
+
+    def acquire(self, key, priority=None, max_wait=None):
+        """Blocks until this caller may make one call against the bucket. Returns the seconds spent queued.
+
+        Raises QuotaWaitTimeout when that would take longer than max_wait.
+        """
+        priority = _request_priority.get() if priority is None else priority
+        started = time.monotonic()
+        deadline = float("inf") if max_wait is None else started + max_wait
+        ticket = (priority, next(self._tickets))
+        with self._cond:
+            bucket = self._bucket(key)
+            heapq.heappush(bucket["waiters"], ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if bucket["rate"]:
+                        bucket["tokens"] = min(QUOTA_BURST, bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+                    bucket["updated"] = now
+                    wake_at = None   # None: wait for the callers ahead to go first
+                    if bucket["waiters"][0] == ticket:
+                        if bucket["paused_until"] > now:
+                            wake_at = bucket["paused_until"]
+                        elif bucket["rate"] and bucket["tokens"] < 1:
+                            wake_at = now + (1 - bucket["tokens"]) / bucket["rate"]
+                        else:
+                            if bucket["rate"]:
+                                bucket["tokens"] -= 1
+                            break
+                    if bucket["paused_until"] > deadline or now >= deadline:
+                        raise QuotaWaitTimeout(f"{key} quota queue is longer than {max_wait:g}s")
+                    timeout = min(float("inf") if wake_at is None else wake_at, deadline) - now
+                    self._cond.wait(None if timeout == float("inf") else timeout)
+            finally:
+                bucket["waiters"].remove(ticket)
+                heapq.heapify(bucket["waiters"])
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            get_tracer().count("quota_wait_seconds", round(waited, 3), bucket=key, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        return waited
+
+    def backoff(self, key, error=None, retry_after=None):
+        """Pauses the bucket after a 429/quota error, for the delay the provider asked for when it names one."""
+        match = RETRY_DELAY_PATTERN.search(str(error or ""))
+        if retry_after is None and match:
+            retry_after = float(match.group(1))
+        with self._cond:
+            bucket = self._bucket(key)
+            pause = retry_after if retry_after is not None else bucket["backoff"]
+            bucket["paused_until"] = max(bucket["paused_until"], time.monotonic() + min(pause, QUOTA_MAX_BACKOFF))
+            bucket["backoff"] = min(bucket["backoff"] * 2, QUOTA_MAX_BACKOFF)
+        get_tracer().count("quota_backoffs", bucket=key)
+
+    def resumes_in(self, key):
+        """Seconds until a paused bucket takes calls again (0 if it is not paused)."""
+        with self._cond:
+            bucket = self._buckets.get(key)
+            return max(0.0, bucket["paused_until"] - time.monotonic()) if bucket else 0.0
+
+    def succeeded(self, key):
+        with self._cond:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket["backoff"] = QUOTA_BACKOFF
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._cond:
+            return {key: {"per_minute": b["rate"] * 60, "queued": len(b["waiters"]), "paused_for": max(0.0, round(b["paused_until"] - now, 1))}
+                    for key, b in self._buckets.items()}
+
+
+@process_resource()
+def get_quota_scheduler():
+    """One scheduler per server process: every session, batch worker and the trend scout share its buckets."""
+    return QuotaScheduler()
+
+
+def acquire_model_call(model_id, max_wait=QUOTA_MAX_WAIT):
+    """Queues for the Gemini project bucket, then the model's own. Returns the seconds spent queued."""
+    scheduler = get_quota_scheduler()
+    return scheduler.acquire(f"gemini:{model_id}", max_wait=max_wait) + scheduler.acquire("gemini", max_wait=max_wait)
+
+
+def report_model_result(model_id, error=None):
+    """Feeds a model call's outcome back to its bucket: 429s pause it, a success resets its backoff."""
+    if error is None:
+        get_quota_scheduler().succeeded(f"gemini:{model_id}")
+    elif is_rate_limit_error(error):
+        get_quota_scheduler().backoff(f"gemini:{model_id}", error)
+
+
+def run_with_model_fallback(run, models=None, breaker=None, on_note=None, agent="agent"):
+    """Calls run(model_id) on each usable model in fallback order until one succeeds.
+
+    Only the caller's own work is retried, so other agents' finished sections are never thrown away.
+    If every model turned out to be rate limited, the call queues on whichever model's quota reopens
+    first (up to QUOTA_RETRIES times) instead of failing. Re-raises the last error otherwise.
+    Traced as one "agent" span with a "model" span per attempt (skipped models included, so the
+    waterfall shows why a fallback was used).
+    """
+    models = models if models is not None else FALLBACK_MODELS
+    breaker = breaker if breaker is not None else get_model_breaker()
+    scheduler = get_quota_scheduler()
+    tracer = get_tracer()
+    last_error = RuntimeError("every model is cooling down after recent failures")
+    rate_limited_only = True   # every failure so far was a rate limit (or a model skipped for one)
+
+    def note(text):
+        if on_note:
+            on_note(text)
+
+    with tracer.span(agent, "agent") as agent_span:
+        def attempt(model_id):
+            nonlocal last_error, rate_limited_only
+            try:
+                with tracer.span(model_id, "model", agent=agent) as model_span:
+                    model_span["attrs"]["queued_s"] = round(acquire_model_call(model_id), 3)
+                    result = run(model_id)
+            except CancelledRun:
+                raise
+            except QuotaWaitTimeout as e:
+                # Our own queue is long, the model is not failing: move on without tripping the breaker
+                last_error = e
+                note(f"⏳ `{model_id}` is busy. Switching to next engine...")
+                return False, None
+            except Exception as e:
+                report_model_result(model_id, e)
+                breaker.record_failure(model_id, e)
+                last_error = e
+                rate_limited_only = rate_limited_only and is_rate_limit_error(e)
+                note(f"⚠️ `{model_id}` error. Switching to next engine...")
+                return False, None
+            report_model_result(model_id)
+            breaker.record_success(model_id)
+            agent_span["attrs"]["model"] = model_id
+            return True, result
+
+        for model_id in models:
+            if not breaker.allow(model_id, models):
+                tracer.end_span(tracer.start_span(model_id, "model", agent=agent), "skipped")
+                rate_limited_only = rate_limited_only and breaker.snapshot().get(model_id, {}).get("reason") == "rate limited"
+                note(f"⏭️ Skipping `{model_id}` (recently failing)")
+                continue
+            ok, result = attempt(model_id)
+            if ok:
+                return result
+
+        # Every engine is out of quota: wait our turn on the one that reopens first rather than fail the section
+        for _ in range(QUOTA_RETRIES if rate_limited_only and models else 0):
+            model_id = min(models, key=lambda m: scheduler.resumes_in(f"gemini:{m}"))
+            note(f"⏳ Every engine is rate limited. Queued for `{model_id}`...")
+            ok, result = attempt(model_id)
+            if ok:
+                return result
+            if not rate_limited_only or isinstance(last_error, QuotaWaitTimeout):
+                break
+        raise last_error
+
+
+# --- CONTENT-ADDRESSED DOSSIER CACHE ---
+DOSSIER_CACHE_TTL = 7 * 86400
+DOSSIER_CACHE_MAX_ENTRIES = 500
+DOSSIER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def dossier_cache_key(destination, days, month, budget, persona, preferences):
+    """Content address of a trip request: SHA-256 over its normalized parameters."""
+    canonical = {
+        "destination": normalize_image_query(destination),
+        "days": int(days),
+        "month": month,
+        "budget": budget,
+        "persona": persona,
+        "preferences": " ".join(str(preferences or "").lower().split()),
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DossierCache:
+    """Finished dossiers on disk, one JSON file per trip key, with TTL plus entry-count and total-size bounds.
+
+    The index (key -> size, created) lives in memory in LRU order and is rebuilt from the directory on start,
+    so a restarted server keeps serving yesterday's dossiers.
+    """
+
+    def __init__(self, directory, ttl=DOSSIER_CACHE_TTL, max_entries=DOSSIER_CACHE_MAX_ENTRIES, max_bytes=DOSSIER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._index = collections.OrderedDict()   # key -> {"size", "created"}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _scan(self):
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json")]
+        except OSError:
+            return
+        found = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            found.append((stat.st_mtime, name[:-5], stat.st_size))
+        for created, key, size in sorted(found):  # oldest first == least recently used
+            self._index[key] = {"size": size, "created": created}
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    def _drop(self, key):
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry["size"]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self._index.items() if e["created"] + self.ttl <= now]:
+            self._drop(key)
+        while self._index and (len(self._index) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._index)))
+            self.evictions += 1
+
+    def get(self, key):
+        """Returns the stored dossier text, or None on a miss/expiry."""
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and entry["created"] + self.ttl <= time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                content = json.load(f)["content"]
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self._drop(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key, params, content):
+        payload = json.dumps({"params": params, "content": content, "created": time.time()})
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old is not None:
+                self._bytes -= old["size"]
+            size = len(payload.encode("utf-8"))
+            self._index[key] = {"size": size, "created": time.time()}
+            self._bytes += size
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+@process_resource()
+def get_dossier_cache():
+    """One dossier cache per server process, shared by every session."""
+    return DossierCache(os.path.join(CACHE_DIR, "dossiers"))
+
+
+# --- STRUCTURED DOSSIER MODEL ---
+DOSSIER_SEPARATOR = "---TAB_SEPARATOR---"   # legacy flat format, still accepted from older caches
+LOCATION_PATTERN = re.compile(r"^###\s*📍\s*(.+?)\s*$", re.MULTILINE)
+
+
+def build_dossier(welcome, itinerary, hotels, logistics, complete=True):
+    """Parses the four agent sections once, at generation time, into the model every render/export reads."""
+    # Split the text beautifully by the mandatory Day header
+    parts = re.split(r'(## Day \d+:.*)', itinerary)
+    days = []
+    for i in range(1, len(parts), 2):
+        body = parts[i+1] if i+1 < len(parts) else ""
+        days.append({"title": parts[i].replace("## ", "").strip(), "body": body, "locations": LOCATION_PATTERN.findall(body)})
+    dossier = {"welcome": welcome, "intro": parts[0], "days": days, "hotels": hotels, "logistics": logistics, "complete": complete}
+    dossier["id"] = _dossier_id(dossier)
+    return dossier
+
+
+def _dossier_id(dossier):
+    content = {key: value for key, value in dossier.items() if key != "id"}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def patch_dossier(dossier, **changes):
+    """A copy of the dossier with some fields replaced and a fresh id; the original is left untouched."""
+    patched = dict(dossier, **changes)
+    patched["id"] = _dossier_id(patched)
+    return patched
+
+
+def load_dossier(stored):
+    """Accepts a structured dossier or the legacy separator-joined string."""
+    if isinstance(stored, dict):
+        return stored
+    parts = stored.split(DOSSIER_SEPARATOR)
+    if len(parts) >= 4:
+        return build_dossier(*(part.strip() for part in parts[:4]))
+    return build_dossier("", stored, "", "", complete=False)
+
+
+def dossier_to_markdown(dossier):
+    """Flat Markdown rendition of a dossier, for downloads."""
+    itinerary = dossier["intro"] + "".join(f"## {day['title']}{day['body']}" for day in dossier["days"])
+    if not dossier["complete"]:
+        return itinerary
+    return "\n\n---\n\n".join([dossier["welcome"], itinerary, dossier["hotels"], dossier["logistics"]])
+
+
+# --- SHARED DOSSIER STORE ---
+DOSSIER_STORE_DECODED = 16                        # decoded dossiers kept ready for reruns, across all sessions
+DOSSIER_STORE_MEMORY_BYTES = 32 * 1024 * 1024     # compressed dossiers held in memory
+DOSSIER_STORE_DISK_BYTES = 256 * 1024 * 1024      # compressed dossiers spilled to disk
+DOSSIER_STORE_LEVEL = 6
+
+
+class DossierStore:
+    """Finished dossiers addressed by their content id, shared by every session so each holds only the id.
+
+    Three tiers, each least-recently-used first out: a handful of decoded dossiers (the ones being looked at right
+    now), zlib-compressed JSON in memory, and the same compressed bytes on disk. Dossiers are immutable, so a
+    decoded one is handed to every reader as is; edits go through patch_dossier and come back as a new id.
+    """
+
+    def __init__(self, directory, decoded=DOSSIER_STORE_DECODED, memory_bytes=DOSSIER_STORE_MEMORY_BYTES, disk_bytes=DOSSIER_STORE_DISK_BYTES):
+        self.directory = directory
+        self.decoded = decoded
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._decoded = collections.OrderedDict()   # id -> dossier
+        self._memory = collections.OrderedDict()    # id -> compressed bytes
+        self._memory_total = 0
+        self._disk = collections.OrderedDict()      # id -> size
+        self._disk_total = 0
+        self._lock = threading.Lock()
+        self.hits = {"decoded": 0, "memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = 0
+        try:
+            names = [(os.path.getmtime(os.path.join(directory, n)), n) for n in os.listdir(directory) if n.endswith(".json.z")]
+        except OSError:
+            names = []
+        for _, name in sorted(names):   # oldest first == least recently used
+            size = os.path.getsize(os.path.join(directory, name))
+            self._disk[name[:-7]] = size
+            self._disk_total += size
+        with self._lock:
+            self._evict()
+
+    def _path(self, dossier_id):
+        return os.path.join(self.directory, f"{dossier_id}.json.z")
+
+    def _evict(self):
+        while len(self._decoded) > self.decoded:
+            self._decoded.popitem(last=False)
+        while self._memory and self._memory_total > self.memory_bytes:
+            _, blob = self._memory.popitem(last=False)   # still on disk
+            self._memory_total -= len(blob)
+        while self._disk and self._disk_total > self.disk_bytes:
+            dossier_id, size = self._disk.popitem(last=False)
+            self._disk_total -= size
+            self.evictions += 1
+            if dossier_id in self._memory:
+                self._memory_total -= len(self._memory.pop(dossier_id))
+            self._decoded.pop(dossier_id, None)
+            try:
+                os.remove(self._path(dossier_id))
+            except OSError:
+                pass
+
+    def put(self, dossier):
+        """Stores a dossier (a no-op if its id is already known) and returns the id sessions keep."""
+        dossier_id = dossier["id"]
+        with self._lock:
+            if dossier_id in self._disk or dossier_id in self._memory:
+                self._decoded[dossier_id] = self._decoded.get(dossier_id, dossier)
+                self._decoded.move_to_end(dossier_id)
+                self._evict()
+                return dossier_id
+        blob = zlib.compress(json.dumps(dossier, ensure_ascii=False).encode("utf-8"), DOSSIER_STORE_LEVEL)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, self._path(dossier_id))
+            on_disk = True
+        except OSError:
+            on_disk = False   # memory only; it is lost when evicted from there
+        with self._lock:
+            if on_disk and dossier_id not in self._disk:
+                self._disk[dossier_id] = len(blob)
+                self._disk_total += len(blob)
+            if dossier_id not in self._memory:
+                self._memory[dossier_id] = blob
+                self._memory_total += len(blob)
+            self._decoded[dossier_id] = dossier
+            self._evict()
+        return dossier_id
+
+    def get(self, dossier_id):
+        """The dossier for an id, decompressed only if it is not already decoded; None once it has been evicted."""
+        if not dossier_id:
+            return None
+        with self._lock:
+            dossier = self._decoded.get(dossier_id)
+            if dossier is not None:
+                self._decoded.move_to_end(dossier_id)
+                self.hits["decoded"] += 1
+                return dossier
+            blob = self._memory.get(dossier_id)
+            tier = "memory"
+            if blob is not None:
+                self._memory.move_to_end(dossier_id)
+            elif dossier_id not in self._disk:
+                self.misses += 1
+                return None
+        if blob is None:
+            tier = "disk"
+            try:
+                with open(self._path(dossier_id), "rb") as f:
+                    blob = f.read()
+            except OSError:
+                blob = None
+        try:
+            dossier = json.loads(zlib.decompress(blob)) if blob is not None else None
+        except (zlib.error, ValueError):
+            dossier = None
+        with self._lock:
+            if dossier is None:
+                self._disk_total -= self._disk.pop(dossier_id, 0)
+                self.misses += 1
+                return None
+            self.hits[tier] += 1
+            if dossier_id in self._disk:
+                self._disk.move_to_end(dossier_id)
+            if tier == "disk" and dossier_id not in self._memory:
+                self._memory[dossier_id] = blob
+                self._memory_total += len(blob)
+            self._decoded[dossier_id] = dossier
+            self._evict()
+        return dossier
+
+    def stats(self):
+        with self._lock:
+            return {
+                "decoded": len(self._decoded),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_total,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_total,
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+@process_resource()
+def get_dossier_store():
+    """One dossier store per server process; sessions keep only the ids it hands out."""
+    return DossierStore(os.path.join(CACHE_DIR, "dossier_store"))
+
+
+# --- OFFLINE EXPORT ---
+EXPORT_FORMATS = {"html": "text/html", "zip": "application/zip"}
+EXPORT_BYTES_MAX = 256 * 1024 * 1024
+EXPORT_LAYOUT = 2                 # bump when the bundle layout changes, so cached bundles are rebuilt
+EXPORT_CHUNK = 256 * 1024         # bytes of embedded image encoded and written at a time
+EXPORT_STYLE = (
+    "body{font-family:-apple-system,'Segoe UI',Roboto,sans-serif;max-width:860px;margin:2rem auto;padding:0 1rem;"
+    "line-height:1.6;color:#1f2937}img{max-width:100%;height:auto}h1,h2,h3{line-height:1.25}"
+    "hr{border:0;border-top:1px solid #e5e7eb;margin:2rem 0}"
+    "blockquote{margin:1rem 0;padding:.25rem 1rem;border-left:4px solid #e5e7eb;background:#f9fafb}blockquote p{margin:.5rem 0}"
+    "@media print{h2{break-before:page}img{break-inside:avoid}}"
+)
+_INLINE_MARKDOWN = [
+    (re.compile(r"\*\*(.+?)\*\*"), r"<strong>\1</strong>"),
+    (re.compile(r"(?<![*\w])\*(?!\s)(.+?)(?<!\s)\*(?!\*)"), r"<em>\1</em>"),
+    (re.compile(r"\[([^\]]+)\]\((https?://[^)\s\"'<>]+)\)"), r'<a href="\2">\1</a>'),
+]
+_ALLOWED_TAG = re.compile(r"<img\s[^>]*>|<br\s*/?>", re.IGNORECASE)
+_SAFE_IMG_SRC = re.compile(r"""\ssrc=["'](https?://[^"'<>\s]+)["']""", re.IGNORECASE)
+_KEPT = re.compile("\x00(\\d+)\x00")
+
+
+def _safe_tag(tag):
+    """The only markup kept from model output: <br>, and <img> reduced to an http(s) src (None drops the tag)."""
+    if not tag.lower().startswith("<img"):
+        return "<br>"
+    src = _SAFE_IMG_SRC.search(tag)
+    return f'<img src="{src.group(1)}" alt="">' if src else None
+
+
+def markdown_to_html(text):
+    """Just enough Markdown for the agents' output (headings, lists, quotes, rules, emphasis, links).
+
+    The text comes from models reading web results and ends up in a standalone page, so everything is escaped
+    except the <img>/<br> markup the agents are told to emit, rebuilt from its src alone.
+    """
+    out, paragraph, list_tag, quote = [], [], None, []
+
+    def flush():
+        nonlocal list_tag
+        if quote:
+            out.append("<blockquote>" + "".join("<p>" + "<br>".join(lines) + "</p>" for lines in quote if lines) + "</blockquote>")
+            quote.clear()
+        if paragraph:
+            out.append("<p>" + "<br>".join(paragraph) + "</p>")
+            paragraph.clear()
+        if list_tag:
+            out.append(f"</{list_tag}>")
+            list_tag = None
+
+    for raw in text.splitlines():
+        kept = []
+
+        def keep(match):
+            tag = _safe_tag(match.group(0))
+            if tag is None:
+                return ""
+            kept.append(tag)
+            return f"\x00{len(kept) - 1}\x00"
+
+        stripped = raw.strip()
+        quoted = stripped.startswith(">")
+        if quoted:
+            stripped = stripped[1:].strip()
+        line = html.escape(_ALLOWED_TAG.sub(keep, stripped), quote=False)
+        for pattern, replacement in _INLINE_MARKDOWN:
+            line = pattern.sub(replacement, line)
+        standalone = line.startswith("\x00") and not _KEPT.sub("", line).strip()
+        line = _KEPT.sub(lambda m: kept[int(m.group(1))], line)
+        heading = re.match(r"(#{1,6})\s+(.*)", line)
+        item = re.match(r"(?:([-*+])|\d+[.)])\s+(.*)", line)
+        if quoted:
+            if not quote:
+                flush()
+                quote.append([])
+            if line:
+                quote[-1].append(line)
+            elif quote[-1]:
+                quote.append([]) # a bare ">" starts the quote's next paragraph
+            continue
+        if quote:
+            flush()
+        if not line:
+            flush()
+        elif re.fullmatch(r"(-{3,}|\*{3,}|_{3,})", line):
+            flush()
+            out.append("<hr>")
+        elif heading:
+            flush()
+            out.append(f"<h{len(heading.group(1))}>{heading.group(2)}</h{len(heading.group(1))}>")
+        elif item:
+            tag = "ul" if item.group(1) else "ol"
+            if paragraph or list_tag != tag:
+                flush()
+                out.append(f"<{tag}>")
+                list_tag = tag
+            out.append(f"<li>{item.group(2)}</li>")
+        elif standalone and not paragraph:
+            flush()
+            out.append(line)
+        else:
+            if list_tag:
+                flush()
+            paragraph.append(line)
+    flush()
+    return "\n".join(out)
+
+
+class DossierExporter:
+    """Self-contained bundles of a dossier, built once per dossier and format and then served from disk.
+
+    "html" is one page with every photo inlined as a data: URI; "zip" holds index.html and itinerary.md pointing at
+    images/ inside the archive. Photos are fetched concurrently through ImageBytes (so ones the proxy or an earlier
+    export already has cost nothing) and written one at a time, so building a bundle never holds more than one
+    image in memory. A photo that cannot be fetched keeps its original URL.
+    """
+
+    def __init__(self, images, cache):
+        self.images = images
+        self.cache = cache
+        self._flights = InFlight()
+
+    def open(self, dossier, fmt, title="Travel Dossier"):
+        """The bundle opened for binary reading, built first unless this dossier was already exported in fmt and title."""
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"unknown export format: {fmt}")
+        titled = hashlib.sha256(title.encode("utf-8")).hexdigest()[:8] # the title is baked into the bundle
+        key = f"{dossier['id'][:40]}-{titled}-{fmt}-{EXPORT_LAYOUT}"
+        bundle = self.cache.open(key)
+        if bundle is not None:
+            get_tracer().count("exports", format=fmt, result="cached")
+            return bundle
+        owned, joined = self._flights.claim([key])
+        if joined:
+            joined[key].result()   # another session is building the same bundle
+        else:
+            error = None
+            try:
+                with get_tracer().span("export", "export", format=fmt):
+                    self._build(dossier, fmt, title, key)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._flights.settle(key, error=error)
+            get_tracer().count("exports", format=fmt, result="built")
+        bundle = self.cache.open(key)
+        if bundle is None:
+            raise OSError("export could not be stored")
+        return bundle
+
+    def _build(self, dossier, fmt, title, key):
+        markdown = dossier_to_markdown(dossier)
+        sources = list(dict.fromkeys(m.group(2) for m in IMG_SRC_PATTERN.finditer(markdown)))
+        # Fetched concurrently into the byte cache on the image pool; only a yes/no is kept until each is written
+        fetched = {src: self.images.prefetch(src) for src in sources}
+
+        def image(src):
+            return self.images.image(src) if fetched[src].result() else None
+
+        page = (f'<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">'
+                f"<title>{html.escape(title)}</title><style>{EXPORT_STYLE}</style></head><body>\n{markdown_to_html(markdown)}\n</body></html>\n")
+        f, tmp_path = self.cache.temp_file()
+        try:
+            with f:
+                if fmt == "html":
+                    self._write_html(f, page, image)
+                else:
+                    self._write_zip(f, page, markdown, sources, image)
+            self.cache.adopt(key, tmp_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def _write_html(self, f, page, image):
+        position = 0
+        for match in IMG_SRC_PATTERN.finditer(page):
+            f.write(page[position:match.start(2)].encode("utf-8"))
+            position = match.end(2)
+            data = image(match.group(2))
+            if data is None:
+                f.write(match.group(2).encode("utf-8"))
+                continue
+            f.write(b"data:image/webp;base64,")
+            step = EXPORT_CHUNK - EXPORT_CHUNK % 3   # whole 3-byte groups, so the chunks concatenate into one base64 string
+            for start in range(0, len(data), step):
+                f.write(base64.b64encode(data[start:start + step]))
+        f.write(page[position:].encode("utf-8"))
+
+    def _write_zip(self, f, page, markdown, sources, image):
+        local = {}
+        with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as bundle:
+            for src in sources:
+                data = image(src)
+                if data is not None:
+                    local[src] = f"images/{len(local) + 1:03d}.webp"
+                    bundle.writestr(local[src], data, compress_type=zipfile.ZIP_STORED)   # WebP is already compressed
+
+            def relink(text):
+                return IMG_SRC_PATTERN.sub(lambda m: m.group(1) + local.get(m.group(2), m.group(2)) + m.group(3), text)
+
+            bundle.writestr("index.html", relink(page))
+            bundle.writestr("itinerary.md", relink(markdown))
+
+
+@process_resource()
+def get_exporter():
+    """One exporter per server process; bundles are cached on disk by dossier id and shared by every session."""
+    return DossierExporter(get_image_bytes(), ByteCache(os.path.join(CACHE_DIR, "exports"), EXPORT_BYTES_MAX, ".bundle"))
+
+
+# --- AGENT ROSTER (built once per role & model, reused by every session) ---
+# Instructions are trip-independent so one Agent per (role, model) can serve everyone; the trip brief travels in the run message.
+AGENT_ROLES = {
+    "itinerary": {
+        "name": "Itinerary Planner",
+        "tools": True,
+        "instructions": [
+            "You are the Itinerary Planner. The request gives the destination, trip length, month, traveler, budget and preferences.",
+            "Generate ONLY the day-by-day schedule.",
+            # OPTION 3 REQUIREMENT: Strict Header formatting
+            "CRITICAL: You MUST start every single day with this exact header format: `## Day [Number]: [Theme of the Day]` (e.g., `## Day 1: Arrival & City Exploration`).",
+            "For EVERY single location or restaurant, you MUST use this exact layout:",
+            "### 📍 [Name of Location]",
+            "**⏱️ Suggested Time:** [e.g., 2 hours] | **[🗺️ View on Google Maps](https://www.google.com/maps/search/?api=1&query=Location+Name)**",
+            "<br><br>",
+            "<img src=\"[REAL_IMG: Location Name, City]\">",
+            "<br><br>",
+            "*Write a short, engaging description.*",
+            "> 🚊 **Transit to next location:** [e.g., 15 mins by subway/bus] | **Route:** From [Nearest Station/Stop of CURRENT location] to [Nearest Station/Stop of NEXT location]",
+            "CRITICAL IMAGE RULE: You MUST use the exact syntax <img src=\"[REAL_IMG: Location Name, City]\"> for images."
+        ],
+    },
+    "logistics": {
+        "name": "Logistics Expert",
+        "tools": True,
+        "instructions": [
+            "You are the Logistics Expert for the trip in the request.",
+            "Generate ONLY practical logistics and local rules.",
+            "- **Flight & Airports:** Major entry points.",
+            "- **Weather:** What to pack for this month.",
+            "- **Transport:** Best way to get around.",
+            "- **Etiquette:** 3 local rules to respect."
+        ],
+    },
+    "hotels": {
+        "name": "Hotel Concierge",
+        "tools": True,
+        "instructions": [
+            "You are the Hotel Concierge. Find the hotels asked for in the request.",
+            "For EVERY hotel, use this exact layout:",
+            "### 🏨 [Hotel Name]",
+            "**[🗺️ View on Google Maps](https://www.google.com/maps/search/?api=1&query=Hotel+Name)**",
+            "<br><br>",
+            "<img src=\"[REAL_IMG: Hotel Name, City]\">",
+            "<br><br>",
+            "*Write a short explanation.*"
+        ],
+    },
+    "editor": {
+        "name": "Chief Editor",
+        "tools": False,
+        "instructions": [
+            "You are the Chief Editor of a premium travel dossier. Write exactly what the request asks for."
+        ],
+    },
+    "trend_scout": {
+        "name": "Trend Scout",
+        "tools": False,
+        "instructions": [
+            "You are an expert travel trend analyst for the Hong Kong market.",
+            "Identify the top 3 trending international travel destinations for Hong Kong tourists right now. Consider seasonal trends, favorable exchange rates (like the Japanese Yen), and current popularity.",
+            "Return ONLY a valid JSON array. Do NOT wrap it in markdown backticks (```json).",
+            'Format exactly like this: [{"destination": "City, Country", "description": "Short catchy description (max 10 words)"}]'
+        ],
+    },
+}
+
+
+def _agno_classes():
+    """Heavy imports, deferred until an agent is actually needed (landing-page reruns never pay for them)."""
+    from agno.agent import Agent
+    from agno.models.google import Gemini
+    from agno.tools.serpapi import SerpApiTools
+    return Agent, Gemini, SerpApiTools
+
+
+def _keys_fingerprint():
+    """Changes whenever an API key changes, which retires every cached client built with the old keys."""
+    return hashlib.sha256(f"{API_KEYS['google']}|{API_KEYS['serpapi']}".encode("utf-8")).hexdigest()[:16]
+
+
+@process_resource(max_entries=16)
+def _gemini_model(model_id, keys_fingerprint):
+    """One Gemini client per model, shared by every role."""
+    _, Gemini, _ = _agno_classes()
+    model = Gemini(id=model_id, api_key=API_KEYS["google"])
+    # agno creates the genai.Client lazily without a lock: agents racing on first use each build one, and the
+    # loser is garbage-collected (closing its connection pool) mid-request. Creating it here makes no network call.
+    model.get_client()
+    return model
+
+
+def _scheduled_search(function_name, function_call, arguments):
+    """agno tool hook: agents' SerpApi searches queue on the same "serpapi" bucket as image Tier 3."""
+    scheduler = get_quota_scheduler()
+    try:
+        scheduler.acquire("serpapi", max_wait=QUOTA_TOOL_MAX_WAIT)
+    except QuotaWaitTimeout:
+        return "Web search is rate limited right now. Continue with what you already know."
+    result = function_call(**arguments)
+    # SerpApiTools reports failures as text rather than raising
+    if isinstance(result, str) and result.startswith("Error") and is_rate_limit_error(result):
+        scheduler.backoff("serpapi", result)
+    else:
+        scheduler.succeeded("serpapi")
+    return result
+
+
+@process_resource(max_entries=64)
+def _build_agent(role, model_id, keys_fingerprint):
+    Agent, _, SerpApiTools = _agno_classes()
+    spec = AGENT_ROLES[role]
+    tools = [SerpApiTools(api_key=API_KEYS["serpapi"])] if spec["tools"] and API_KEYS["serpapi"] else []
+    return Agent(name=spec["name"], model=_gemini_model(model_id, keys_fingerprint), tools=tools, instructions=spec["instructions"],
+                 tool_hooks=[_scheduled_search] if tools else None)
+
+
+def get_agent(role, model_id):
+    """The shared Agent for a (role, model_id), rebuilt only when the API keys change."""
+    return _build_agent(role, model_id, _keys_fingerprint())
+
+
+def run_agent(role, model_id, message):
+    """Non-streaming agent run that records the run's tool calls and token usage on the current span."""
+    output = get_agent(role, model_id).run(message, stream=False)
+    record_tool_calls(getattr(output, "tools", None))
+    if getattr(output, "status", None) == "ERROR":
+        # agno reports model errors as a finished run whose content is the error text; raise so fallback sees it
+        raise RuntimeError(output.content or f"{role} run failed")
+    metrics = getattr(output, "metrics", None)
+    span = get_tracer().current()
+    if span is not None and metrics is not None:
+        span["attrs"].update(input_tokens=getattr(metrics, "input_tokens", None), output_tokens=getattr(metrics, "output_tokens", None))
+    return output.content
+
+
+# --- THE DAILY AI TREND SCOUT ---
+TRENDING_MAX_AGE = 86400        # refresh the trends once a day
+TRENDING_RETRY_AFTER = 900      # after a failed refresh, keep serving the old value this long before retrying
+
+# Failsafe: Static trends, only used before the scout has ever succeeded
+STATIC_TRENDING = [
+    {"destination": "Tokyo, Japan", "description": "Neon lights, ancient temples, and culinary perfection.", "image_url": "https://images.unsplash.com/photo-1540959733332-eab4deabeeaf?auto=format&fit=crop&w=600&h=400&q=80"},
+    {"destination": "Paris, France", "description": "Art, romance, and café culture by the Seine.", "image_url": "https://images.unsplash.com/photo-1499856871958-5b9627545d1a?auto=format&fit=crop&w=600&h=400&q=80"},
+    {"destination": "Banff, Canada", "description": "Crystal lakes, towering peaks, and ultimate wilderness.", "image_url": "https://images.unsplash.com/photo-1550236520-7050f3582da0?auto=format&fit=crop&w=600&h=400&q=80"}
+]
+
+
+def scout_trending_destinations():
+    """Fetches trending destinations for HK travelers autonomously and gets real photos. Raises on failure."""
+    with request_priority(PRIORITY_BACKGROUND): # queues behind every visitor and batch job
+        acquire_model_call("gemini-2.5-flash")
+        agent = get_agent("trend_scout", "gemini-2.5-flash")
+        try:
+            response = agent.run("Get top 3 trending destinations for HK tourists.", stream=False).content
+        except Exception as e:
+            report_model_result("gemini-2.5-flash", e)
+            raise
+        report_model_result("gemini-2.5-flash")
+    
+    # Strip potential markdown formatting just in case
+    cleaned_response = response.replace("```json", "").replace("```", "").strip()
+    destinations = json.loads(cleaned_response)[:3]
+    
+    # Prefetch all three photos in parallel (shares the process-wide image cache)
+    image_cache = get_image_cache()
+    with request_priority(PRIORITY_BACKGROUND):
+        urls = resolve_images([dest['destination'] for dest in destinations], image_cache)
+    for dest in destinations:
+        dest['image_url'] = urls[dest['destination']]
+    image_cache.flush()
+        
+    return destinations
+
+
+class TrendingStore:
+    """Stale-while-revalidate holder for the trend scout's output.
+
+    Readers always get the last good value immediately; when it is older than max_age a single
+    background thread regenerates it. The value is persisted, so a cold process start serves
+    yesterday's trends instead of blocking on Gemini.
+    """
+
+    def __init__(self, path, refresh, max_age=TRENDING_MAX_AGE, retry_after=TRENDING_RETRY_AFTER):
+        self.path = path
+        self.refresh = refresh
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._value = None
+        self._fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._refreshing = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            self._value, self._fetched_at = stored["destinations"], stored["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get(self):
+        """Returns the last good value (None if there has never been one) and revalidates in the background if stale."""
+        now = time.time()
+        with self._lock:
+            stale = self._value is None or now - self._fetched_at >= self.max_age
+            start = stale and not self._refreshing and now - self._last_attempt >= self.retry_after
+            if start:
+                self._refreshing = True
+                self._last_attempt = now
+            value = self._value
+        if start:
+            threading.Thread(target=self._revalidate, name="trend-scout", daemon=True).start()
+        return value
+
+    def _revalidate(self):
+        try:
+            value = self.refresh()
+        except Exception:
+            value = None  # keep serving the previous value; retried after retry_after
+        with self._lock:
+            self._refreshing = False
+            if not value:
+                return
+            self._value, self._fetched_at = value, time.time()
+            snapshot = {"destinations": self._value, "fetched_at": self._fetched_at}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+@process_resource()
+def get_trending_store():
+    """One trend store per server process, shared by every visitor."""
+    return TrendingStore(os.path.join(CACHE_DIR, "trending.json"), scout_trending_destinations)
+
+
+def get_trending_destinations():
+    """Today's trends without ever blocking the landing page."""
+    return get_trending_store().get() or STATIC_TRENDING
+
+
+# --- HEADLESS GENERATION ---
+TRIP_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+TRIP_BUDGETS = ["Budget/Backpacker", "Mid-Range", "Luxury/Boutique"]
+TRIP_PERSONAS = ["Solo Independent Traveler", "Couple / DINKs", "Family with Young Children", "Seniors / Retirees", "Student Group"]
+TRIP_MAX_DAYS = 14
+TRIP_DEFAULTS = {"days": 4, "month": "Mar", "budget": "Mid-Range", "persona": "Solo Independent Traveler", "preferences": ""}
+
+
+def _choice(value, options, field):
+    text = " ".join(str(value).split()).lower()
+    for option in options:
+        # Months also accept their full name ("march" -> "Mar")
+        if text == option.lower() or (options is TRIP_MONTHS and text[:3] == option.lower() and len(text) >= 3):
+            return option
+    raise ValueError(f"{field} must be one of: {', '.join(options)} (got {value!r})")
+
+
+def normalize_trip(raw):
+    """Validates a trip spec (a dict from the sidebar, a CSV row or a JSON line) against the app's own choices.
+
+    Missing or blank fields take the sidebar defaults; anything else invalid raises ValueError.
+    """
+    trip = dict(TRIP_DEFAULTS)
+    trip.update({k: v for k, v in raw.items() if v is not None and str(v).strip() != ""})
+    destination = " ".join(str(trip.get("destination", "")).split())
+    if not destination:
+        raise ValueError("destination is required")
+    try:
+        days = int(str(trip["days"]).strip())
+    except ValueError:
+        raise ValueError(f"days must be a whole number (got {trip['days']!r})")
+    if not 1 <= days <= TRIP_MAX_DAYS:
+        raise ValueError(f"days must be between 1 and {TRIP_MAX_DAYS} (got {days})")
+    return {
+        "destination": destination,
+        "days": days,
+        "month": _choice(trip["month"], TRIP_MONTHS, "month"),
+        "budget": _choice(trip["budget"], TRIP_BUDGETS, "budget"),
+        "persona": _choice(trip["persona"], TRIP_PERSONAS, "persona"),
+        "preferences": str(trip["preferences"]).strip(),
+    }
+
+
+def trip_key(trip):
+    """Dossier cache key of a normalized trip."""
+    return dossier_cache_key(trip["destination"], trip["days"], trip["month"], trip["budget"], trip["persona"], trip["preferences"])
+
+
+def trip_briefs(trip):
+    """Run messages for each role: the shared agents are trip-independent, so every detail of the trip goes here."""
+    destination, persona = trip["destination"], trip["persona"]
+    return {
+        "itinerary": (f"Create the day-by-day itinerary for a {trip['days']}-day trip to {destination} in {trip['month']}.\n"
+                      f"Traveler: '{persona}'. Budget: '{trip['budget']}'. Preferences: '{trip['preferences']}'."),
+        "logistics": f"Gather logistics for {destination}.",
+        "hotels": f"Find 3 highly-rated hotels in {destination} that fit the {persona} persona.",
+        "editor": f"Write a short, engaging, 1-paragraph 'Executive Welcome' for a {persona} traveling to {destination}.",
+    }
+
+
+def cached_dossier(trip):
+    """The stored dossier for an identical trip (generated by anyone), or None."""
+    stored = get_dossier_cache().get(trip_key(trip))
+    return load_dossier(stored) if stored else None
+
+
+class _EventLog:
+    """Every event of one in-flight generation so far; any number of readers replay it and then follow it live."""
+
+    def __init__(self):
+        self._events = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error = None
+
+    def publish(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def close(self, error=None):
+        with self._cond:
+            self._closed, self._error = True, error
+            self._cond.notify_all()
+
+    def follow(self, idle_timeout):
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._events) > index or self._closed, timeout=idle_timeout)
+                events, closed, error = self._events[index:], self._closed, self._error
+            index += len(events)
+            if not events and not closed:
+                yield "idle", None, None
+            yield from events
+            if closed:
+                if error is not None:
+                    raise error
+                return
+
+
+class GenerationFlights:
+    """Single-flight for whole generations: identical trips requested while one is running share that run.
+
+    The first request starts the pipeline on its own thread, which records every event; it and each identical
+    request arriving before the run ends replay that log from the start and follow it, so all of them see the
+    same progress and get the same dossier (or error). A run outlives viewers that leave: it still lands in the
+    dossier cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._logs = {}   # trip key -> _EventLog
+        self.coalesced = 0
+
+    def attach(self, key, run):
+        """Returns (event log, joined) for the run of this key, starting run() on a new thread if none is in flight."""
+        with self._lock:
+            log = self._logs.get(key)
+            if log is not None:
+                self.coalesced += 1
+                return log, True
+            log = self._logs[key] = _EventLog()
+        threading.Thread(target=self._drive, args=(key, log, run), name="generation", daemon=True).start()
+        return log, False
+
+    def _drive(self, key, log, run):
+        error = None
+        try:
+            for event in run():
+                log.publish(event)
+        except Exception as e:
+            error = e
+        finally:
+            # Unregister before closing: by now the dossier is in the cache, so later requests are served from there
+            with self._lock:
+                self._logs.pop(key, None)
+            log.close(error)
+
+
+@process_resource()
+def get_generation_flights():
+    """Generations in flight across every session in the process, by trip key."""
+    return GenerationFlights()
+
+
+def iter_generation(trip, idle_timeout=1.5, cache=None, priority=PRIORITY_INTERACTIVE):
+    """Generates one trip's dossier, yielding (kind, name, payload) events on the caller's thread as work lands.
+
+    Events: ("start", None, {"trace_id", "engines", "joined"}) first; then ("note", agent, text), ("done", task, None),
+    ("reset", "itinerary", attempt) and ("day", "itinerary", (attempt, index, header, segment)) as they happen,
+    ("idle", None, None) whenever idle_timeout passes quietly; ("images", None, stats) and ("dossier", None, dossier)
+    last. The dossier is also stored in the dossier cache. The first task failure is raised.
+    An identical trip already being generated is joined rather than started again ("joined" is then True).
+    Its model and search calls queue at the given priority (that of whoever started the run, when joined).
+    """
+    trip = normalize_trip(trip)
+    log, joined = get_generation_flights().attach(trip_key(trip), lambda: _run_generation(trip, cache, priority))
+    get_tracer().count("generations", mode="joined" if joined else "started")
+    for kind, name, payload in log.follow(idle_timeout):
+        if kind == "start":
+            payload = dict(payload, joined=joined)
+        yield kind, name, payload
+
+
+def _run_generation(trip, cache=None, priority=PRIORITY_INTERACTIVE):
+    """The pipeline behind iter_generation, for a normalized trip; runs on its own thread and never yields "idle"."""
+    _request_priority.set(priority)   # this thread's context; the graph's tasks inherit it
+    briefs = trip_briefs(trip)
+    cache = cache if cache is not None else get_dossier_cache()
+    tracer = get_tracer()
+    graph = TaskGraph(tracer=tracer) # every task is traced as a phase of this run
+    placeholders = PlaceholderResolver() # one image stage for every section of this dossier
+    day_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    stream_attempts = itertools.count(1)
+
+    def stream_itinerary(model_id):
+        """Streams the itinerary and resolves each day's images the moment that day is closed."""
+        attempt = next(stream_attempts)
+        graph.post("reset", "itinerary", attempt) # a fallback retry replaces anything already reported
+        splitter = DayStreamSplitter()
+        day_futures = []
+
+        def close_day(header, segment):
+            index = len(day_futures)
+            future = day_executor.submit(contextvars.copy_context().run, placeholders.resolve_section, segment)
+            future.add_done_callback(lambda f: f.exception() is None and graph.post("day", "itinerary", (attempt, index, header, f.result())))
+            day_futures.append(future)
+
+        for delta in stream_agent_text(get_agent("itinerary", model_id), briefs["itinerary"]):
+            for header, segment in splitter.feed(delta):
+                close_day(header, segment)
+        for header, segment in splitter.close():
+            close_day(header, segment)
+        return "".join(f.result() for f in day_futures)
+
+    def with_fallback(role, agent_fn):
+        return lambda: run_with_model_fallback(agent_fn, on_note=lambda text: graph.note(role, text), agent=role)
+
+    def agent_task(role):
+        run = with_fallback(role, lambda model_id: run_agent(role, model_id, briefs[role]))
+
+        def task():
+            # Started while the traveler was still configuring: take its finished or in-flight result
+            speculative = get_speculative_runs().adopt(role, briefs[role])
+            if speculative is None:
+                return run()
+            try:
+                result = speculative.result()
+            except Exception:
+                return run()
+            tracer.current()["attrs"]["speculative"] = True
+            graph.note(role, f"⚡ {role.capitalize()} prefetched while you were still configuring")
+            return result
+        return task
+
+    # Each task starts the moment its real inputs exist: all four agents at once,
+    # and each section's images as soon as that section's text arrives.
+    # Every agent falls back through the models on its own, so finished sections are never redone.
+    if STREAM_ITINERARY:
+        # Days arrive already illustrated, so there is no separate itinerary image task
+        graph.add("itinerary", with_fallback("itinerary", stream_itinerary))
+    else:
+        graph.add("itinerary", agent_task("itinerary"))
+        graph.add("itinerary_images", placeholders.resolve_section, deps=["itinerary"])
+    graph.add("logistics", agent_task("logistics"))
+    graph.add("hotels", agent_task("hotels"))
+    graph.add("editor", agent_task("editor"))
+    graph.add("hotel_images", placeholders.resolve_section, deps=["hotels"])
+
+    dossier = None
+    last_error = "abandoned"
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=6)
+    # Root span of this generation: graph phases, agents, model attempts and image tiers all nest under it
+    run_span = tracer.start_span("generate", "run", destination=trip["destination"], days=trip["days"], streaming=STREAM_ITINERARY)
+    run_token = tracer.activate(run_span)
+    try:
+        yield "start", None, {"trace_id": run_span["trace_id"], "engines": get_model_breaker().candidates(FALLBACK_MODELS)}
+        graph.start(executor)
+        while not graph.finished:
+            # Blocks until a task reports in
+            event = graph.next_event()
+            if event[0] == "failed":
+                raise event[2]
+            yield event
+
+        yield "images", None, placeholders.stats()
+        # Parsed once here; every rerun and export reads this structure instead of re-splitting text
+        dossier = build_dossier(graph.result("editor"), graph.result("itinerary" if STREAM_ITINERARY else "itinerary_images"),
+                                graph.result("hotel_images"), graph.result("logistics"))
+        cache.put(trip_key(trip), trip, dossier)
+        proxy = get_image_proxy()
+        if proxy:
+            proxy.warm(dossier_to_markdown(dossier))
+    except Exception as e:
+        last_error = str(e)
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        day_executor.shutdown(wait=False, cancel_futures=True)
+        placeholders.flush()
+        tracer.deactivate(run_token)
+        if dossier:
+            tracer.end_span(run_span)
+        else:
+            tracer.end_span(run_span, "error", error=last_error[:300])
+    yield "dossier", None, dossier
+
+
+def generate_dossier(trip, on_event=None, use_cache=True, priority=PRIORITY_BATCH):
+    """Blocking generation for scripts and batch jobs: an identical stored dossier is returned as-is unless use_cache is off."""
+    if use_cache:
+        dossier = cached_dossier(normalize_trip(trip))
+        if dossier:
+            return dossier
+    dossier = None
+    for kind, name, payload in iter_generation(trip, priority=priority):
+        if kind == "dossier":
+            dossier = payload
+        elif on_event is not None:
+            on_event(kind, name, payload)
+    return dossier
+
+
+# --- INCREMENTAL SECTION REGENERATION ---
+SECTION_ROLES = {"welcome": "editor", "hotels": "hotels", "logistics": "logistics", "day": "itinerary"}
+
+
+def section_brief(trip, dossier, section, day_index=None, note=""):
+    """Run message for redoing one section: the section's normal brief, narrowed to one day for the itinerary."""
+    briefs = trip_briefs(trip)
+    if section == "day":
+        number = day_index + 1
+        elsewhere = [place for i, day in enumerate(dossier["days"]) if i != day_index for place in day["locations"]]
+        brief = (f"{briefs['itinerary']}\nWrite ONLY Day {number} (currently '{dossier['days'][day_index]['title']}'), "
+                 f"starting with its `## Day {number}:` header. Do not write any other day.")
+        if elsewhere:
+            brief += f"\nThe other days already visit: {'; '.join(elsewhere)}. Choose different places."
+    else:
+        brief = briefs[SECTION_ROLES[section]]
+    if note.strip():
+        brief += f"\nThe traveler asked for this change: '{note.strip()}'."
+    return brief
+
+
+def _single_day(text, day_index, fallback_title):
+    """(title, body) of the one day in an agent's answer, numbered as the day it replaces."""
+    headers = list(DAY_HEADER_PATTERN.finditer(text))
+    if not headers:
+        return fallback_title, "\n" + text.strip() + "\n"
+    end = headers[1].start() if len(headers) > 1 else len(text)   # anything past a second day is dropped
+    title = re.sub(r"^Day \d+", f"Day {day_index + 1}", headers[0].group(0).replace("## ", "").strip())
+    return title, text[headers[0].end():end]
+
+
+def regenerate_section(trip, dossier, section, day_index=None, note="", store=None, priority=PRIORITY_INTERACTIVE):
+    """Redoes one section ("welcome", "hotels", "logistics") or one itinerary day with a single agent call.
+
+    Every other section keeps its text and its already-resolved image URLs; only the placeholders in the new
+    text are resolved. Returns the patched copy, kept in the dossier store under its own id; the trip cache keeps
+    the shared dossier, since a key stands for the trip settings alone and not for one traveler's edits.
+    Raises ValueError for an unknown section or day, and the agent's last error if every model fails.
+    """
+    if section not in SECTION_ROLES:
+        raise ValueError(f"section must be one of: {', '.join(SECTION_ROLES)}")
+    if section == "day" and not (isinstance(day_index, int) and 0 <= day_index < len(dossier["days"])):
+        raise ValueError(f"day_index must be between 0 and {len(dossier['days']) - 1}")
+    trip = normalize_trip(trip)
+    role = SECTION_ROLES[section]
+    brief = section_brief(trip, dossier, section, day_index, note)
+    store = store if store is not None else get_dossier_store()
+    tracer = get_tracer()
+    with request_priority(priority), tracer.span("regenerate", "run", section=section, day=day_index, destination=trip["destination"]):
+        text = run_with_model_fallback(lambda model_id: run_agent(role, model_id, brief), agent=role)
+        placeholders = PlaceholderResolver()
+        if section == "day":
+            title, body = _single_day(text, day_index, dossier["days"][day_index]["title"])
+            body = placeholders.resolve_section(body)
+            days = list(dossier["days"])
+            days[day_index] = {"title": title, "body": body, "locations": LOCATION_PATTERN.findall(body)}
+            patched = patch_dossier(dossier, days=days)
+        else:
+            patched = patch_dossier(dossier, **{section: placeholders.resolve_section(text)})
+        placeholders.flush()
+    store.put(patched)
+    return patched
+
+
+# --- SPECULATIVE PREFETCH ---
+SPECULATE = os.environ.get("TRAVEL_PLANNER_SPECULATE", "1") != "0"
+SPECULATIVE_WORKERS = 2          # agent runs in flight on speculation at once, process-wide
+SPECULATIVE_MAX_PENDING = 8      # further speculation is refused rather than queued without bound
+SPECULATIVE_TTL = 600            # seconds a finished speculative result stays adoptable
+SPECULATIVE_MIN_LENGTH = 3       # destinations shorter than this are still being typed
+SPECULATIVE_ROLES = ("logistics", "hotels")   # the sections whose briefs do not depend on days, month, budget or preferences
+
+
+class SpeculativeRuns:
+    """Agent runs started before anyone clicked Generate, keyed by (role, brief) so adoption is exact.
+
+    Runs queue at background priority on a small pool. Each run counts the sessions interested in it;
+    when the last one moves on, a run still waiting for a worker or for quota is cancelled before it
+    calls a model, while one already talking to a model finishes and stays adoptable for ttl seconds.
+    The first run in a fresh process also pays the one-off agno import ahead of the real generation.
+    """
+
+    def __init__(self, workers=SPECULATIVE_WORKERS, max_pending=SPECULATIVE_MAX_PENDING, ttl=SPECULATIVE_TTL):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speculative")
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._runs = collections.OrderedDict()   # (role, brief) -> {"future", "interest", "cancelled", "calling", "finished_at"}
+        self.adopted = 0
+
+    def _expire(self):
+        now = time.time()
+        for key, run in list(self._runs.items()):
+            abandoned = run["cancelled"].is_set() and run["future"].done()
+            if abandoned or (run["finished_at"] and run["finished_at"] + self.ttl <= now):
+                del self._runs[key]
+
+    def start(self, role, brief):
+        """Registers interest in a run, starting it if needed. Returns its key, or None when the pool is full."""
+        key = (role, brief)
+        with self._lock:
+            self._expire()
+            run = self._runs.get(key)
+            if run is not None and not run["cancelled"].is_set():
+                run["interest"] += 1
+                return key
+            if sum(1 for r in self._runs.values() if not r["future"].done()) >= self.max_pending:
+                return None
+            run = {"interest": 1, "cancelled": threading.Event(), "calling": False, "finished_at": None}
+            run["future"] = self.executor.submit(self._run, role, brief, run)
+            run["future"].add_done_callback(lambda _: run.update(finished_at=time.time()))
+            self._runs[key] = run
+        get_tracer().count("speculative_runs", role=role)
+        return key
+
+    def _run(self, role, brief, run):
+        def attempt(model_id):
+            # Checked after the quota queue, under the lock adopt() and release() take: past here the call is made
+            with self._lock:
+                if run["cancelled"].is_set():
+                    raise CancelledRun(f"speculative {role} abandoned")
+                run["calling"] = True
+            return run_agent(role, model_id, brief)
+
+        with request_priority(PRIORITY_BACKGROUND), get_tracer().span("speculate", "run", role=role):
+            text = run_with_model_fallback(attempt, agent=role)
+            # Warms the image cache, so the generation that adopts this text resolves its photos from memory
+            resolve_images(list(dict.fromkeys(PLACEHOLDER_PATTERN.findall(text))))
+            return text
+
+    def release(self, key):
+        """Drops one session's interest; with none left, a run that has not reached a model is cancelled."""
+        with self._lock:
+            run = self._runs.get(key)
+            if run is None:
+                return
+            run["interest"] -= 1
+            if run["interest"] <= 0 and not run["future"].done() and not run["calling"]:
+                run["cancelled"].set()
+                if run["future"].cancel():
+                    del self._runs[key]
+
+    def adopt(self, role, brief):
+        """The Future of a matching run that has finished or is already talking to a model, or None.
+
+        A match still queued at background priority is cancelled instead: the caller runs it at its own.
+        """
+        with self._lock:
+            run = self._runs.get((role, brief))
+            if run is None or run["cancelled"].is_set():
+                return None
+            if not run["future"].done() and not run["calling"]:
+                run["cancelled"].set()
+                if run["future"].cancel():
+                    del self._runs[(role, brief)]
+                return None
+            self.adopted += 1
+        get_tracer().count("speculative_adopted", role=role)
+        return run["future"]
+
+
+@process_resource()
+def get_speculative_runs():
+    """One speculation pool per server process, shared by every session."""
+    return SpeculativeRuns()
+
+
+def speculate(destination, persona=TRIP_DEFAULTS["persona"]):
+    """Starts the destination-only sections for a trip that is still being configured. Returns keys for release_speculation()."""
+    if not SPECULATE or len(destination.strip()) < SPECULATIVE_MIN_LENGTH or not API_KEYS["google"]:
+        return []
+    briefs = trip_briefs(normalize_trip({"destination": destination, "persona": persona}))
+    runs = get_speculative_runs()
+    return [key for key in (runs.start(role, briefs[role]) for role in SPECULATIVE_ROLES) if key is not None]
+
+
+def release_speculation(keys):
+    runs = get_speculative_runs()
+    for key in keys:
+        runs.release(key)